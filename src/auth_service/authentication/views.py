@@ -20,8 +20,6 @@ import requests
 import pyotp
 import qrcode
 import uuid
-import time
-import json
 import base64
 from io import BytesIO
 from qrcode.constants import ERROR_CORRECT_L
@@ -29,38 +27,23 @@ from urllib.parse import urlencode
 from redis import Redis
 from django.core.mail import send_mail
 
-def getStatus(user_id, channel="auth_social"):
+def getStatus(user_id):
     """
-    Evaluate if a user is already logged in.
+    Evaluate if a user is already logged in: the gateway holds presence_<id>
+    while the user has a socket (gateway_service/router/presence.py).
     """
 
     REDIS_PASSOWRD = settings.REDIS_PASSWORD
 
     redis = Redis.from_url(f"redis://:{REDIS_PASSOWRD}@redis:6379", decode_responses=True)
 
-    test = 10
-    data = {
-        'user_id': user_id
-    }
-    status = None
-    print(data)  # debug
-    
-    redis.publish(channel, json.dumps(data))
-    
-    while status is None and test >= 0:
-        try:
-            status = redis.get(f'is_{user_id}_logged')
-            print(f'GET status = {status}')  # debug
-            if status is not None:
-                return status
-        except Exception as e:
-            print(f"Error occurred: {str(e)}")
-            return None
-        
-        time.sleep(0.1)
-        test -= 1
-    
-    return None
+    try:
+        return "online" if redis.exists(f'presence_{user_id}') else "offline"
+    except Exception as e:
+        print(f"Error occurred: {str(e)}")
+        return None
+    finally:
+        redis.close()
 
 class PublicKeyView(APIView):
     permission_classes = [AllowAny]
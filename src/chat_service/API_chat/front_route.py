@@ -0,0 +1,34 @@
+# Front-bound messages go to the gateway replica of their recipient.
+#
+# Each gateway process subscribes to its own channel and keeps
+# front_route_id_<user id> and front_route_name_<username> pointing to it while
+# the user is connected there (gateway_service/router/listener.py).
+# publish_front() looks up the route of header.id (an id if it is an int, else a
+# username) and publishes on that channel, in a single round trip.
+# Without a route (user not connected, gateway restarting), the message goes to
+# the broadcast channel given, like before.
+#
+# Same file in every service that answers the fronts.
+
+import json
+
+PUBLISH_FRONT = """
+local channel = redis.call('GET', KEYS[1]) or ARGV[1]
+return redis.call('PUBLISH', channel, ARGV[2])
+"""
+
+_script = None
+
+
+def route_key(user):
+    if isinstance(user, int):
+        return f"front_route_id_{user}"
+    return f"front_route_name_{user}"
+
+
+async def publish_front(redis_client, channel, data):
+    """Publish data (addressed to data['header']['id']) where its recipient is connected"""
+    global _script
+    if _script is None:
+        _script = redis_client.register_script(PUBLISH_FRONT)
+    return await _script(keys=[route_key(data['header']['id'])], args=[channel, json.dumps(data)], client=redis_client)
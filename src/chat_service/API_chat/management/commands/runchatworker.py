@@ -2,7 +2,9 @@ import json
 import requests
 from signal import signal, SIGTERM, SIGINT
 from django.core.management.base import BaseCommand
-from redis.asyncio import from_url
+from ...redis_pool import redis_pool
+from ...front_route import publish_front
+from ...streams import StreamConsumer
 from asyncio import run as arun, sleep as asleep, create_task
 import os
 from django.conf import settings
@@ -11,7 +13,7 @@ from redis.asyncio import Redis
 import jwt
 from datetime import datetime, timedelta, timezone
 class Command(BaseCommand):
-    help = "Listen to 'deep_chat' pub/sub redis channel"
+    help = "Handle the chat messages of the 'deep_chat_stream' redis stream, as one of the chat workers"
 
     def handle(self, *args, **kwargs):
         signal(SIGINT, self.signal_handler)
@@ -21,15 +23,10 @@ class Command(BaseCommand):
     async def main(self):
         self.running = True
         try:
-            REDIS_PASSWORD = settings.REDIS_PASSWORD
-
-            self.redis_client = await from_url(f"redis://:{REDIS_PASSWORD}@redis:6379", decode_responses=True)
-
-            self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
-            self.group_name = "deep_chat"
-            print(f"Subscribing to channel: {self.group_name}")
-            await self.pubsub.subscribe(self.group_name)
-            self.listen_task = create_task(self.listen())
+            self.redis_client = redis_pool.client()
+            self.group_name = "deep_chat" # answers, see front_route.py
+            self.stream = StreamConsumer(self.redis_client, "deep_chat_stream", self.handle_entry)
+            self.listen_task = create_task(self.stream.run())
             while self.running:
                 await asleep(1)
         except  Exception as e:
@@ -37,16 +34,13 @@ class Command(BaseCommand):
         finally:
             await self.cleanup_redis()
 
-    async def listen(self):
-        print(f"Listening for messages...")
-        async for msg in self.pubsub.listen():
-            if msg :
-                try:
-                    data = json.loads(msg['data'])
-                    if self.valid_chat_json(data):
-                        await self.process_message(data)
-                except Exception as e:
-                    print(e)
+    async def handle_entry(self, data, entry_id):
+        try:
+            valid = self.valid_chat_json(data)
+        except (KeyError, TypeError):
+            valid = False
+        if valid:
+            await self.process_message(data)
 
     def valid_chat_json(self, data):
         if data['header']['dest'] != 'back' or data['header']['service'] != 'chat':
@@ -74,7 +68,7 @@ class Command(BaseCommand):
         except Exception as e:
             print(e)
             data['body']['message'] = str(e)
-        await self.redis_client.publish(self.group_name, json.dumps(data))
+        await publish_front(self.redis_client, self.group_name, data)
 
     async def is_friend(self, exp, recipient) -> bool :
         friends_data = self.get_friend_list(recipient)
@@ -172,8 +166,4 @@ class Command(BaseCommand):
 
     async def cleanup_redis(self):
         print("Cleaning up Redis connections...")
-        if self.pubsub:
-            await self.pubsub.unsubscribe(self.group_name)
-            await self.pubsub.close()
-        if self.redis_client:
-            await self.redis_client.close()
\ No newline at end of file
+        await redis_pool.close()
\ No newline at end of file
@@ -48,29 +48,35 @@ export class MainSocket {
 
 		this.socket.onmessage = async (e)=> {
 			let data = JSON.parse(e.data);
-			// console.log(JSON.stringify(data, null, 2));
-			switch (data['header']['service']) {
-				case 'chat':
-					state.chatApp.incomingMsg(data);
-					break;
-				case 'social':
-					state.socialApp.incomingMsg(data.body);
-					break
-				case 'mmaking':
-					//if (await state.mmakingApp.waited_page)
-					state.mmakingApp.incomingMsg(data);
-					break;
-				case 'notify':
-					// console.log("mainSocket : incoming notify");
-					state.socialApp.renderNoBuild();
-					renderFriendProfile(data);
-					break;
-				default:
-				console.warn('mainSocket : could not handle incoming JSON' + JSON.stringify(data, null, 2));
-			}
+			// the gateway groups the messages sent within a few ms in one frame
+			for (const message of data.batch ?? [data])
+				this.handleMessage(message);
 		};
     };
 
+	handleMessage(data) {
+		// console.log(JSON.stringify(data, null, 2));
+		switch (data['header']['service']) {
+			case 'chat':
+				state.chatApp.incomingMsg(data);
+				break;
+			case 'social':
+				state.socialApp.incomingMsg(data.body);
+				break
+			case 'mmaking':
+				//if (await state.mmakingApp.waited_page)
+				state.mmakingApp.incomingMsg(data);
+				break;
+			case 'notify':
+				// console.log("mainSocket : incoming notify");
+				state.socialApp.renderNoBuild();
+				renderFriendProfile(data);
+				break;
+			default:
+			console.warn('mainSocket : could not handle incoming JSON' + JSON.stringify(data, null, 2));
+		}
+	}
+
 	send(data) {
 		// I added this check because it appears that sending without while still .CONNECTING
 		// breaks the socket permanently? Not sure about this...
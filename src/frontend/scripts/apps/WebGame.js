@@ -4,6 +4,93 @@ import * as LEVELS from '../game3d/gameobjects/levels/levels.js';
 import { navigator } from '../nav.js'
 
 
+// Binary game-state frames, must be kept in sync with game/frames.py
+const FRAME_VERSION = 3;
+const FRAME = {
+    BALL: 1 << 0,
+    BALL_DIR: 1 << 1,
+    LPOS: 1 << 2,
+    RPOS: 1 << 3,
+    SIZE: 1 << 4,
+    SCORES: 1 << 5,
+    RESYNC: 1 << 6,
+    KEYFRAME: 1 << 7,
+};
+
+// Frames arrive at a lower rate than the screen refresh rate, so positions are
+// interpolated between the two frames surrounding (now - INTERPOLATION_DELAY).
+const INTERPOLATION_DELAY = 100;  // ms
+// Spectators only get a keyframe every 100ms (SPECTATOR_HZ in game/const.py).
+const SPECTATOR_INTERPOLATION_DELAY = 250;  // ms
+const MAX_SNAPSHOTS = 16;
+// A dropped game socket is reopened for that long, the server keeps the game
+// for GRACE_PERIOD (game/checkpoint.py) before cancelling it.
+const RECONNECT_WINDOW = 20000;  // ms
+const RECONNECT_DELAY = 1000;  // ms between two attempts
+// Our own paddle is predicted: inputs move it at once, and are replayed over the
+// latest frame, which acknowledges the inputs it contains (acks in game/frames.py).
+const DEFAULT_RTT = 100;  // ms, until the first input is acknowledged
+const INPUT_HISTORY = 2000;  // ms of inputs kept to replay them
+
+// (a - b) for 16 bits input sequence numbers, which wrap around
+function seqDiff(a, b) {
+    return ((a - b + 0x8000) & 0xFFFF) - 0x8000;
+}
+
+// Paddle moves held between from and to (ms): sum of key * duration.
+function integrateInputs(history, from, to) {
+    let total = 0;
+    for (let i = 0; i < history.length; i++) {
+        const start = Math.max(history[i].time, from);
+        const end = Math.min(i + 1 < history.length ? history[i + 1].time : to, to);
+        if (end > start)
+            total += history[i].key * (end - start);
+    }
+    return total;
+}
+
+/**
+ * Decode a frame into `state`. Delta frames only overwrite the fields they contain.
+ * Frames can be lost on the way (channel layer): after a gap in the sequence,
+ * deltas are ignored until the next keyframe, which comes within a second.
+ * @param {ArrayBuffer} buffer
+ * @returns {boolean} false if the frame could not be used.
+ */
+function decodeFrame(buffer, state) {
+    const view = new DataView(buffer);
+    const version = view.getUint8(0);
+    const flags = view.getUint8(1);
+    if (version != FRAME_VERSION) {
+        console.error('Unsupported game frame version', version);
+        return false;
+    }
+    const sequence = view.getUint32(2, true);
+    if (!(flags & FRAME.KEYFRAME)) {
+        if (state.hasKeyframe && sequence != ((state.sequence + 1) >>> 0))
+            state.hasKeyframe = false;  // missed a delta, our base is wrong
+        if (!state.hasKeyframe) {
+            state.sequence = sequence;
+            return false;  // can't apply a delta without a base
+        }
+    }
+    state.hasKeyframe = true;
+    state.sequence = sequence;
+    state.time = view.getUint32(6, true);
+    state.acks = [view.getUint16(10, true), view.getUint16(12, true)];
+    state.resync = (flags & FRAME.RESYNC) != 0;
+    let offset = 14;
+    const f32 = () => { const v = view.getFloat32(offset, true); offset += 4; return v; };
+    const u8 = () => view.getUint8(offset++);
+    if (flags & FRAME.BALL)     { state.ball = [f32(), f32()]; }
+    if (flags & FRAME.BALL_DIR) { state.ballDir = [f32(), f32()]; }
+    if (flags & FRAME.LPOS)     { state.lpos = f32(); }
+    if (flags & FRAME.RPOS)     { state.rpos = f32(); }
+    if (flags & FRAME.SIZE)     { state.size = [f32(), f32()]; state.padSpeed = f32(); }
+    if (flags & FRAME.SCORES)   { state.scores = [u8(), u8()]; }
+    return true;
+}
+
+
 export class WebGame extends GameBase {
 
     constructor() {
@@ -17,6 +104,22 @@ export class WebGame extends GameBase {
         // web game does not send this until game start, so the paddles would be invisible
         // for the initial countdown.
         this.paddleHeights = [0.2, 0.2];
+
+        this.frameState = { hasKeyframe: false };
+        this.snapshots = [];
+        this.clockOffset = null;  // local time - game time, in ms
+        this.interpolationDelay = INTERPOLATION_DELAY;
+        this.spectator = false;
+        this.gameId = null;
+        this.ticket = null;
+        this.reconnectDeadline = null;  // set while the socket is being reopened
+
+        this.inputSeq = 0;
+        this.pendingInputs = new Map();  // seq -> local send time, until a frame acknowledges it
+        this.inputHistory = [];  // {time, key} of our inputs, in local time
+        this.rtt = DEFAULT_RTT;
+        this.ownPaddle = null;  // {pos, receivedAt}: our paddle in the latest frame
+        this.frozenUntil = 0;  // paddles don't move during pauses
     }
 
     frame(delta, time) {
@@ -24,6 +127,8 @@ export class WebGame extends GameBase {
             this.sendLoadReady();
         }
 
+        this.interpolate();
+
         try {
             this.#sendInput();
         } catch (error) {
@@ -34,6 +139,7 @@ export class WebGame extends GameBase {
     }
 
     close(youCancelled) {
+        this.reconnectDeadline = null;
         try {
             if ((this.socket != null)
                 &&(this.socket.readyState !== this.socket.CLOSED)
@@ -57,14 +163,54 @@ export class WebGame extends GameBase {
     }
 
 
-    async launchGameSocket(gameId) {
+    /**
+     * @param {boolean} spectate Read-only: watch the game instead of playing it.
+     * @param {string} ticket Signed by matchmaking, lets the game server admit us without asking it.
+     */
+    async launchGameSocket(gameId, spectate = false, ticket = null) {
         await state.client.refreshSession();
 		await navigator.goToPage('');
-        let socketURL = "wss://" + window.location.hostname + ":3000/game/" + gameId + "/?t=" + state.client.accessToken;
+        this.spectator = spectate;
+        if (spectate)
+            this.interpolationDelay = SPECTATOR_INTERPOLATION_DELAY;
+        this.gameId = gameId;
+        this.ticket = ticket;
+        this.#openSocket();
+    }
+
+    /**
+     * The socket dropped in the middle of the game: reopen it, the server resumes the game
+     * from its checkpoint once we are back.
+     */
+    async reconnect() {
+        const now = performance.now();
+        if (this.reconnectDeadline === null) {
+            this.reconnectDeadline = now + RECONNECT_WINDOW;
+            this.frozenUntil = Infinity;
+            this.level?.pause(RECONNECT_WINDOW / 1000);
+        }
+        if (now > this.reconnectDeadline) {
+            this.close(false);
+            return;
+        }
+        setTimeout(async () => {
+            if (this.reconnectDeadline === null)
+                return;
+            await state.client.refreshSession();
+            this.#openSocket();
+        }, RECONNECT_DELAY);
+    }
+
+    #openSocket() {
+        const route = this.spectator ? "/watch/" : "/";
+        let socketURL = "wss://" + window.location.hostname + ":3000/game/" + this.gameId + route + "?t=" + state.client.accessToken;
+        if (this.ticket)
+            socketURL += "&ticket=" + this.ticket;
         // websocat ws://pong:8006/game/1234/?t=
 
         try {
             this.socket = new WebSocket(socketURL);
+            this.socket.binaryType = 'arraybuffer';
             this.socket.gameApp = this;
         }
         catch (error) {
@@ -75,10 +221,18 @@ export class WebGame extends GameBase {
 
         this.socket.onerror = async function(e) {
             console.error('Game socket: onerror:', e);
+            if (this.gameApp.reconnectDeadline !== null)
+                return;
 			await state.mmakingApp.socketGameError();
         };
 
         this.socket.onopen = async function(e) {
+            if (this.gameApp.spectator)
+                return;
+            if (this.gameApp.reconnectDeadline !== null) {
+                this.gameApp.reconnectDeadline = null;  // the server takes it from here
+                return;
+            }
             this.send(JSON.stringify({
                 'action' :"wannaplay!",
                 })
@@ -88,13 +242,24 @@ export class WebGame extends GameBase {
         };
 
         this.socket.onclose = async function(e) {
-            if (this.gameApp instanceof WebGame) {
-                this.gameApp.socket = null;
+            if (!(this.gameApp instanceof WebGame))
+                return;
+            // Not closed by us (close() forgets the socket before this runs): try to get back in the game.
+            const dropped = this.gameApp.socket === this;
+            this.gameApp.socket = null;
+            if (dropped && this.gameApp.receivedInit && !this.gameApp.spectator)
+                this.gameApp.reconnect();
+            else
                 this.gameApp.close(false);
-            }
         };
 
         this.socket.onmessage = async function(e) {
+            if (e.data instanceof ArrayBuffer) {
+                if (this.gameApp instanceof WebGame) {
+                    this.gameApp.applyFrame(e.data);
+                }
+                return;
+            }
             let data = JSON.parse(e.data);
             const wg = this.gameApp;
             if (!(wg instanceof WebGame)) {
@@ -110,13 +275,21 @@ export class WebGame extends GameBase {
             // if (data.action != 'info') { console.log('Game packet:', data.action, ', data = ', data); }
 
             if (data.action == 'init') {
-                wg.level = new (LEVELS.LIST[data.level_name])();
+                // A resumed game keeps its level, but the game clock went back to the round start.
+                if (!data.resume || !wg.level)
+                    wg.level = new (LEVELS.LIST[data.level_name])();
+                wg.snapshots = [];
+                wg.clockOffset = null;
+                wg.pendingInputs.clear();
+                wg.ownPaddle = null;
                 wg.receivedInit = true;
                 wg.side = Number(data.side);
                 wg.playerNames[0] = data.lplayer;
                 wg.playerNames[1] = data.rplayer;
                 // Did we load before the server was ready? Then report it now.
-                if (state.engine.scene != null) {
+                if (wg.spectator) {
+                    chooseHeader('ingame');
+                } else if (state.engine.scene != null) {
                     wg.sendLoadReady();
                 } else {
                     wg.needToReportLoaded = true;
@@ -134,7 +307,12 @@ export class WebGame extends GameBase {
 
                 wg.level?.unpause();
             }
+            if (data.action == "opponent_left") {
+                wg.frozenUntil = performance.now() + Number(data.grace) * 1000;
+                wg.level?.pause(Number(data.grace));
+            }
             if (data.action == "wait") {
+                wg.frozenUntil = performance.now() + Number(data.time) * 1000;
                 wg.level?.pause(Number(data.time));
             }
             if (data.action == "disconnect") {
@@ -145,22 +323,119 @@ export class WebGame extends GameBase {
                 wg.level?.endShowWebOpponentQuit(opponentName);
             }
             if (data.action == "game_won") {
+                wg.frozenUntil = Infinity;
                 wg.level?.endShowWinner(data.scores, data.winner, [...wg.playerNames]);
             }
         };
     }
 
 
+    applyFrame(buffer) {
+        const state = this.frameState;
+        if (!decodeFrame(buffer, state))
+            return;
+        this.paddleHeights[0] = state.size[0];
+        this.paddleHeights[1] = state.size[1];
+        this.scores[0] = state.scores[0];
+        this.scores[1] = state.scores[1];
+
+        if (state.resync)
+            this.snapshots = [];
+        this.snapshots.push({
+            time: state.time,
+            ball: state.ball,
+            paddles: [state.lpos, state.rpos],
+        });
+        if (this.snapshots.length > MAX_SNAPSHOTS)
+            this.snapshots.shift();
+        if (!this.spectator && (this.side == 0 || this.side == 1))
+            this.#acknowledge(state);
+
+        // Follow the lowest observed delay, and slowly adapt if it grows.
+        const offset = performance.now() - state.time;
+        if (this.clockOffset === null || offset < this.clockOffset)
+            this.clockOffset = offset;
+        else
+            this.clockOffset += (offset - this.clockOffset) * 0.05;
+
+        this.level?.unpause();
+    }
+
+    interpolate() {
+        const snapshots = this.snapshots;
+        if (snapshots.length == 0)
+            return;
+        const renderTime = performance.now() - this.clockOffset - this.interpolationDelay;
+
+        let from = snapshots[0];
+        let to = from;
+        for (let i = 1; i < snapshots.length && from.time < renderTime; i++) {
+            to = snapshots[i];
+            if (to.time >= renderTime)
+                break;
+            from = to;
+        }
+        if (renderTime >= to.time)
+            from = to;  // no newer frame yet, hold the last one
+
+        const t = (to.time > from.time)
+            ? Math.min(Math.max((renderTime - from.time) / (to.time - from.time), 0), 1)
+            : 1;
+        this.ballPosition.x = from.ball[0] + (to.ball[0] - from.ball[0]) * t;
+        this.ballPosition.y = from.ball[1] + (to.ball[1] - from.ball[1]) * t;
+        this.paddlePositions[0] = from.paddles[0] + (to.paddles[0] - from.paddles[0]) * t;
+        this.paddlePositions[1] = from.paddles[1] + (to.paddles[1] - from.paddles[1]) * t;
+        if (this.ownPaddle)
+            this.paddlePositions[this.side] = this.#predictOwnPaddle();
+    }
+
+    #acknowledge(frame) {
+        const now = performance.now();
+        const ack = frame.acks[this.side];
+        for (const [seq, sentAt] of this.pendingInputs) {
+            if (seqDiff(ack, seq) < 0)
+                continue;
+            if (seq == ack)
+                this.rtt += (now - sentAt - this.rtt) * 0.2;
+            this.pendingInputs.delete(seq);
+        }
+        while (this.inputHistory.length > 1 && this.inputHistory[1].time < now - INPUT_HISTORY)
+            this.inputHistory.shift();
+        this.ownPaddle = {
+            pos: this.side == 0 ? frame.lpos : frame.rpos,
+            receivedAt: now,
+        };
+    }
+
+    // The frame contains the inputs we sent up to a round trip before receiving it:
+    // replay the ones after that, without going through the pauses.
+    #predictOwnPaddle() {
+        const now = performance.now();
+        const from = Math.max(this.ownPaddle.receivedAt - this.rtt, this.frozenUntil);
+        const moved = (this.frameState.padSpeed ?? 0) * integrateInputs(this.inputHistory, from, now) / 1000;
+        const limit = this.level?.boardSize ? this.level.boardSize.y / 2 : Infinity;
+        return Math.min(Math.max(this.ownPaddle.pos + moved, -limit), limit);
+    }
+
+
     #sendInput() {
-        if (!this.receivedInit || !state.isPlaying || this.socket.readyState != this.socket.OPEN)
+        if (this.spectator || !this.receivedInit || !state.isPlaying || !this.socket || this.socket.readyState != this.socket.OPEN)
             return;
 
         let currentInput = state.input.getPaddleInput(this.side);
         if (this.previousInput != currentInput) {
-            let input = JSON.stringify({
+            const now = performance.now();
+            this.inputSeq = (this.inputSeq + 1) & 0xFFFF;
+            this.pendingInputs.set(this.inputSeq, now);
+            this.inputHistory.push({ time: now, key: currentInput });
+            const move = {
                 "action": "move",
-                "key": currentInput
-            });
+                "key": currentInput,
+                "seq": this.inputSeq,
+            };
+            if (this.clockOffset !== null)
+                move.t = Math.max(0, Math.round(now - this.clockOffset));  // game time we are at
+            let input = JSON.stringify(move);
             if (state.cliDebug)
                 console.log('Game input:', input);
             this.socket.send(input);
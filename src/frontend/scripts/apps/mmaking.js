@@ -37,6 +37,7 @@ export class Mmaking
 		this.type_game = null;
 		this.game = null;
 		this.gameId = null;
+		this.gameTicket = null;
 		this.bracket = false;
 		this.winnerId_of_tournament = null;
 		this.tournament = false
@@ -280,6 +281,7 @@ export class Mmaking
 		this.SearchRandomGame = false;
 		this.game = false;
 		this.gameId = null;
+		this.gameTicket = null;
 		this.salonHost = false;
 		this.tournament = false;
 
@@ -380,7 +382,7 @@ export class Mmaking
 				if (state.gameApp != null)
 					state.gameApp.close(true);
 				state.gameApp = new WebGame();
-				state.gameApp.launchGameSocket(this.gameId);
+				state.gameApp.launchGameSocket(this.gameId, false, this.gameTicket);
 				chooseHeader('loading');
 				this.game = false;
 			}
@@ -633,6 +635,7 @@ export class Mmaking
         {
 			this.game = true;
 			this.gameId =  data.body.id_game;
+			this.gameTicket = data.body.ticket;
 			this.salonInvite = false;
 			this.salonLoad = false;
 			this.SearchRandomGame = false;
@@ -2,7 +2,8 @@ import { state } from './main.js';
 import { initHomePage, initProfilePage } from "./pages.js";
 import { mainErrorMessage } from './utils.js';
 import { closeDynamicCard, initDynamicCard } from './components/dynamic_card.js';
-import { ft_fetch } from './main.js';
+import { ft_fetch, chooseHeader } from './main.js';
+import { WebGame } from './apps/WebGame.js';
 
 class Navigator {
     constructor() {
@@ -94,6 +95,13 @@ class Navigator {
                 return this.goToPage('', null, true);
             case 'profile':
                 return this.goToPage('profile', userId || null, true);
+            case 'spectate': // #spectate/<game id>: watch a game, read-only
+                if (!userId || !isAuth)
+                    return this.goToPage('', null, true);
+                state.gameApp = new WebGame();
+                state.gameApp.launchGameSocket(userId, true);
+                chooseHeader('loading');
+                return;
             default:
                 return this.goToPage('404', null, true);
         }
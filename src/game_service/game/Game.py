@@ -1,8 +1,14 @@
 from random import choice
-from time import time
-from asyncio import sleep as asleep
-from .const import LEFT, RIGHT, FPS, DELTATIME, GREEN, RED, RESET, STATS, LEVELS
-from .bounce import bounce
+from asyncio import CancelledError, create_task, shield, sleep as asleep
+from .const import LEFT, RIGHT, SIMULATION_HZ, SNAPSHOT_INTERVAL, SPECTATOR_INTERVAL, DELTATIME, GREEN, RED, RESET, STATS, LEVELS
+from .bounce import bounce, time_of_impact, X_AXIS, Y_AXIS, MAX_BOUNCES_PER_TICK
+from .scheduler import scheduler
+from .frames import FrameEncoder
+from .fanout import local_groups, encoded
+from .replay import InputLog, replay_key, REPLAY_TTL
+from .spectate import spectator_feed
+from .metrics import inputs, input_lag, frames_sent
+from .checkpoint import write_checkpoint, delete_checkpoint, release_lease, CHECKPOINT_INTERVAL, GRACE_PERIOD
 
 
 class Player:
@@ -14,6 +20,8 @@ class Player:
         self.pos = 0
         self.pad_size = STATS['initialPadSize']
         self.move = 0
+        self.last_input = 0 # sequence number of the last input applied, echoed in the frames
+        self.input_lag = None # ms between the game time seen by the client and the input reaching the game
 
     def move_paddle(self, speed, board_half_height):
         is_too_low = self.pos <= -board_half_height
@@ -31,16 +39,27 @@ class Game:
 
     def __init__(self, game_id, id1, username1, id2, username2, wsh, level_name):
         self.wsh = wsh
+        self.level_name = level_name
         self.level = LEVELS[level_name]
         self.players = [Player(username1, id1), Player(username2, id2)]
         self.over = False
+        self.dropped = False # set before cancelling play() when the game won't be resumed
         self.id = game_id
         self.ball_speed = STATS['initialBallSpeed']
         self.pad_speed = STATS['initialPadSpeed']
         self.round_start_mult = choice([1, -1])
         self.loaded = False
         self.was_not_loaded = True
+        self.paused_ticks = 0
+        self.ticks = 0
+        self.resync = True
+        self.frames = FrameEncoder()
+        self.feed = None # set by play(), replays and benchmarks have no spectators
+        self.spectator_frames = FrameEncoder()
+        self.spectator_resync = True
+        self.replay = InputLog(level_name, self.round_start_mult, [(id1, username1), (id2, username2)])
         self.recenter()
+        self.checkpoint = self.round_state()
         print(f"{GREEN}New game {game_id}: **{self.players[LEFT].name}({self.players[LEFT].id})** vs {self.players[RIGHT].name}({self.players[RIGHT].id}), on level '{level_name}'.{RESET}")
 
     def recenter(self):
@@ -49,33 +68,70 @@ class Game:
         self.players[0].pos = self.players[1].pos = 0
 
     async def new_round(self):
-        # Send "info" manually, so the client can display the new score without waiting the pause.
-        await self.wsh.channel_layer.group_send(
-            self.wsh.room_group_name, {"type": "handle.message", "message": self.get_game_state()}
-        )
+        # Send a frame manually, so the client can display the new score without waiting the pause.
+        await self.send_frame(keyframe=True)
         self.recenter()
         self.ball_speed *= STATS['ballAccelerateFactor']
         self.pad_speed *= STATS['padAccelerateFactor']
         self.players[0].pad_size *= STATS['padShrinkFactor']
         self.players[1].pad_size = self.players[0].pad_size
+        self.checkpoint = self.round_state()
         await self.eepytime(1)
 
 
+    def round_state(self):
+        """What is needed to restart the current round, see checkpoint.py"""
+        return {
+            "level_name": self.level_name,
+            "players": [[p.id, p.name, p.score, p.pad_size] for p in self.players],
+            "ball_speed": self.ball_speed,
+            "pad_speed": self.pad_speed,
+            "round_start_mult": self.round_start_mult,
+            "ticks": self.ticks,
+            "over": self.over,
+        }
+
+    @classmethod
+    def from_checkpoint(cls, game_id, state, wsh):
+        (id1, name1, score1, size1), (id2, name2, score2, size2) = state["players"]
+        game = cls(game_id, id1, name1, id2, name2, wsh, state["level_name"])
+        game.players[0].score, game.players[0].pad_size = score1, size1
+        game.players[1].score, game.players[1].pad_size = score2, size2
+        game.ball_speed = state["ball_speed"]
+        game.pad_speed = state["pad_speed"]
+        game.round_start_mult = state["round_start_mult"]
+        game.ticks = state["ticks"]
+        game.over = state["over"]
+        game.replay = None # the inputs before the checkpoint don't lead to this state anymore
+        game.recenter()
+        game.checkpoint = game.round_state()
+        return game
+
     async def move_ball(self):
-        # move
-        self.ball_pos[0] += DELTATIME * self.ball_direction[0] * self.ball_speed
-        self.ball_pos[1] += DELTATIME * self.ball_direction[1] * self.ball_speed
+        # Swept collisions: move the ball edge to edge, bouncing at the exact time of
+        # impact, until DELTATIME is used up. Works the same at any tick rate / ball speed.
         HALF_BOARD = [ self.level["board_size"][0] / 2, self.level["board_size"][1] / 2 ]
-        # top / bottom collision
-        if (self.ball_pos[1] <= -HALF_BOARD[1] or self.ball_pos[1] >= HALF_BOARD[1]):
-            self.ball_direction[1] *= -1
-        # left / right collision
-        if (self.ball_pos[0] < -HALF_BOARD[0]):
-            await self.side_collided(RIGHT)
-        elif (self.ball_pos[0] > HALF_BOARD[0]):
-            await self.side_collided(LEFT)
+        remaining = DELTATIME
+        for _ in range(MAX_BOUNCES_PER_TICK):
+            time, axis = time_of_impact(self.ball_pos, self.ball_direction, self.ball_speed, HALF_BOARD)
+            if time > remaining:
+                self.ball_pos[0] += remaining * self.ball_direction[0] * self.ball_speed
+                self.ball_pos[1] += remaining * self.ball_direction[1] * self.ball_speed
+                return
+            self.ball_pos[0] += time * self.ball_direction[0] * self.ball_speed
+            self.ball_pos[1] += time * self.ball_direction[1] * self.ball_speed
+            remaining -= time
+            # snap to the edge, so that float errors never leave the ball outside the board
+            self.ball_pos[axis] = HALF_BOARD[axis] if self.ball_direction[axis] > 0 else -HALF_BOARD[axis]
+            # top / bottom collision
+            if axis == Y_AXIS:
+                self.ball_direction[1] *= -1
+            # left / right collision
+            elif await self.side_collided(LEFT if self.ball_direction[0] > 0 else RIGHT):
+                return
 
     async def side_collided(self, side):
+        """Ball reached the paddles' line. Returns True if it scored."""
         is_ball_below_paddle = self.ball_pos[1] < self.players[side].pos - self.players[side].pad_size/2
         is_ball_above_paddle = self.ball_pos[1] > self.players[side].pos + self.players[side].pad_size/2
 
@@ -84,20 +140,27 @@ class Game:
             self.round_start_mult = -1 if side == 1 else 1
             self.players[1 - side].score_up(self)
             await self.new_round()
+            return True
 
         # the ball hit the paddle -> Bounce
-        else:
-            # Undo movement, so that there is no way the ball is still outside the board
-            # on next frame's check... maybe with an extremely shallow trajectory.
-            self.ball_pos[1] -= DELTATIME * self.ball_direction[1] * self.ball_speed
-            self.ball_direction = bounce(
-                self.ball_direction, self.ball_pos,
-                self.players[side].pos, self.players[side].pad_size,
-                side
-            )
-
-    def set_player_move(self, id, move):
+        self.ball_direction = bounce(
+            self.ball_direction, self.ball_pos,
+            self.players[side].pos, self.players[side].pad_size,
+            side
+        )
+        return False
+
+    def set_player_move(self, id, move, seq=None, sent_at=None):
+        """seq and sent_at (the client's estimate of time_ms) come with the inputs of prediction-aware clients"""
         self.players[id].move = int(move)
+        inputs.inc()
+        if seq is not None:
+            self.players[id].last_input = seq
+        if sent_at is not None:
+            self.players[id].input_lag = max(0, self.time_ms - sent_at)
+            input_lag.observe(self.players[id].input_lag / 1000)
+        if self.replay:
+            self.replay.record(self.ticks, id, self.players[id].move)
 
     def move_players(self):
         for player in self.players:
@@ -115,43 +178,133 @@ class Game:
             "rscore": self.players[RIGHT].score,
         }
 
-    async def eepytime(self, time = 1):
-        await self.wsh.channel_layer.group_send(
-            self.wsh.room_group_name, {"type": "wait.a.bit", "time": time}
+    async def group_send(self, message):
+        await local_groups.group_send(
+            self.wsh.channel_layer, self.wsh.room_group_name, message, len(self.players)
         )
-        await asleep(time)
-
-
-    async def play(self):
-        last_frame_time = time()
-        while not self.over:
-            current_time = time()
-            elapsed_time = current_time - last_frame_time
-            if elapsed_time < DELTATIME:
-                await asleep(DELTATIME - elapsed_time)
-            if self.loaded:
-                if self.was_not_loaded:
-                    self.was_not_loaded = False
-                    await self.eepytime(3)
-                await self.wsh.channel_layer.group_send(
-                    self.wsh.room_group_name, {"type": "handle.message", "message": self.get_game_state()}
-                )
-                self.move_players()
-                await self.move_ball()
-            last_frame_time = time()
+
+    @property
+    def time_ms(self):
+        return self.ticks * 1000 // SIMULATION_HZ
+
+    async def send_frame(self, keyframe=False):
+        frame = self.frames.encode(self, keyframe, self.resync)
+        self.resync = False
+        await self.group_send({"type": "handle.frame", "frame": frame})
+        frames_sent.inc("players")
+
+    async def eepytime(self, time = 1):
+        # The pause is counted in ticks, so the scheduler keeps driving the game.
+        await self.group_send(encoded({"action": "wait", "time": time}))
+        self.paused_ticks = round(time * SIMULATION_HZ)
+        self.resync = True # clients must not interpolate across the pause
+        self.spectator_resync = True
+
+    @property
+    def finished(self):
+        return self.over and self.paused_ticks <= 0
+
+    async def tick(self):
+        """Advance the game by one DELTATIME step. Called by the scheduler."""
+        if not self.loaded:
+            return
+        self.ticks += 1
+        if self.was_not_loaded:
+            self.was_not_loaded = False
+            await self.eepytime(3)
+        if self.paused_ticks > 0:
+            self.paused_ticks -= 1
+            return
+        if self.over:
+            return
+        if self.ticks % SNAPSHOT_INTERVAL == 0:
+            await self.send_frame()
+        if self.feed and self.ticks % SPECTATOR_INTERVAL == 0:
+            self.feed.publish(self.id, self.spectator_frames.encode(self, True, self.spectator_resync))
+            self.spectator_resync = False
+        self.move_players()
+        await self.move_ball()
+
+    async def play(self, feed=spectator_feed):
+        self.feed = feed
+        if self.feed:
+            self.feed.open(self)
+        checkpoints = create_task(self.keep_checkpoint())
+        try:
+            await scheduler.run(self)
+        except CancelledError:
+            checkpoints.cancel()
+            if self.dropped:
+                await self.drop()
+            else:
+                await self.suspend()
+            raise
+        finally:
+            checkpoints.cancel()
         await self.endgame_by_victory()
 
+    async def keep_checkpoint(self):
+        while True:
+            await self.save_checkpoint()
+            await asleep(CHECKPOINT_INTERVAL)
+
+    async def save_checkpoint(self, suspended=False):
+        state = dict(self.checkpoint, suspended=True) if suspended else self.checkpoint
+        try:
+            await write_checkpoint(self.wsh.redis_client, self.id, state, self.wsh.channel_name)
+        except Exception as e:
+            print(f"{RED}Could not checkpoint game {self.id}: {e}{RESET}")
+
+    async def suspend(self):
+        """A player left: last checkpoint, then let whoever resumes the game own it.
+        The spectators wait for it, like the player still there."""
+        await self.save_checkpoint(suspended=True)
+        try:
+            await release_lease(self.wsh.redis_client, self.id, self.wsh.channel_name)
+        except Exception as e:
+            print(f"{RED}Could not release game {self.id}: {e}{RESET}")
+        if self.feed:
+            self.feed.pause(self.id, {"action": "wait", "time": GRACE_PERIOD})
+
+    async def drop(self):
+        """The game is over without a winner: nothing to resume."""
+        try:
+            await delete_checkpoint(self.wsh.redis_client, self.id)
+        except Exception as e:
+            print(f"{RED}Could not delete checkpoint of game {self.id}: {e}{RESET}")
+        if self.feed:
+            self.feed.close(self.id, {"action": "game_cancelled"})
+
+    # A player leaving on game_won cancels play() during the endgame: the result is
+    # recorded before anyone hears of it, and can't be interrupted.
     async def endgame_by_victory(self):
-        await self.wsh.channel_layer.group_send(
-            self.wsh.room_group_name, {
-                "type": "declare.winner",
-                "winner": 0 if self.players[0].score > self.players[1].score else 1,
-                "scores":  [self.players[0].score, self.players[1].score]
-        })
-        await self.wsh.send_score()
-        await self.wsh.channel_layer.group_send(
-            self.wsh.room_group_name, {"type": "disconnect.now", "from": "server"}
-        )
+        winner = 0 if self.players[0].score > self.players[1].score else 1
+        scores = [self.players[0].score, self.players[1].score]
+        if self.feed:
+            self.feed.close(self.id, {"action": "game_won", "winner": winner, "scores": scores})
+        await shield(self.record_result())
+        await self.group_send(encoded({"action": "game_won", "winner": winner, "scores": scores}))
+        await self.save_replay()
+        await self.group_send(encoded({"action": "disconnect"}))
+
+    async def record_result(self):
+        """The score goes to matchmaking, and the game can't be resumed anymore."""
+        try:
+            await delete_checkpoint(self.wsh.redis_client, self.id)
+        except Exception as e:
+            print(f"{RED}Could not delete checkpoint of game {self.id}: {e}{RESET}")
+        try:
+            await self.wsh.send_score()
+        except Exception as e:
+            print(f"{RED}Could not send the score of game {self.id}: {e}{RESET}")
+
+    async def save_replay(self):
+        if not self.replay:
+            return
+        try:
+            await self.wsh.redis_client.set(replay_key(self.id), self.replay.to_text(), ex=REPLAY_TTL)
+        except Exception as e:
+            print(f"{RED}Could not save replay of game {self.id}: {e}{RESET}")
 
     def get_score(self):
         data = {
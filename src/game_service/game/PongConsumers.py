@@ -1,16 +1,27 @@
 import json
-import requests
+import jwt
 import time
+from urllib.parse import parse_qs
 from asyncio import create_task, sleep as asleep, CancelledError
-from redis.asyncio import from_url #type: ignore
 from channels.generic.websocket import AsyncWebsocketConsumer #type: ignore
+from channels.exceptions import ChannelFull #type: ignore
 from .Game import Game
-from .const import RESET, RED, YELLOW, GREEN, LEFT, RIGHT, LEVELS
+from .fanout import local_groups
+from .spectate import spectator_feed
+from .redis_pool import redis_pool
+from .workers import simulation_is_remote, send_to_worker, worker_channel
+from .metrics import flood_mutes, frames_dropped, inputs_dropped, connect_phase
+from .checkpoint import read_checkpoint, delete_checkpoint, take_lease, GRACE_PERIOD, SUSPEND_WAIT
+from .const import RESET, RED, YELLOW, GREEN, LEFT, RIGHT, LEVELS, STATS
 from collections import deque
 import random
 import math
 from django.conf import settings
 
+# Sent as is, encoded once
+GAME_CANCELLED = json.dumps({"action": "game_cancelled"})
+DISCONNECT = json.dumps({"action": "disconnect"})
+
 class InvalidPacket(Exception):
     pass
 
@@ -19,7 +30,7 @@ class PongConsumer(AsyncWebsocketConsumer):
     MESSAGE_LIMIT = 20 # each player input counts 2 (keydown and keyup)
     TIME_WINDOW = 1 # seconds
     UNMUTE_TIME = 5 # seconds
-    MAX_MESSAGE_SIZE = 50
+    MAX_MESSAGE_SIZE = 80 # {"action":"move","key":-1,"seq":65535,"t":4294967295}
 
     WAITING_FOR_OPPONENT = 10 # seconds
 
@@ -32,13 +43,15 @@ class PongConsumer(AsyncWebsocketConsumer):
         self.nb_players = 0
         self.master = False
         self.game = None
+        self.level_name = None
+        self.owner_channel = None # channel of the master consumer, which owns the game
         self.task = None
+        self.resuming = False # came back to a suspended game, see checkpoint.py
+        self.grace_task = None # waiting for the opponent to come back
         self.side = None
         self.room_group_name = None
         self.mute = False
-        self.public_key = None
         self.redis_client = None
-        self.pubsub = None
         self.connected = False
         self.loaded = [False, False]
         self.message_timestamps = deque(maxlen=self.MESSAGE_LIMIT) # collecting message's timestamp
@@ -53,36 +66,51 @@ class PongConsumer(AsyncWebsocketConsumer):
             await self.kick(message="Unauthentified")
             return
         try:
-            await self.join_redis_channels()
+            self.redis_client = redis_pool.client() # shared by the whole process, never closed here
+            start_time = time.monotonic()
             if not await self.check_game_info():
                 await self.close()
                 return
+            connect_phase.observe(time.monotonic() - start_time, "check_game_info")
             await self.accept()
             self.connected = True
             self.room_group_name = f"game_{self.game_id}"
             await self.channel_layer.group_add(self.room_group_name, self.channel_name)
-            await self.wait_for_opponent()
+            local_groups.add(self.room_group_name, self)
+            if self.resuming:
+                await self.rejoin()
+            else:
+                start_time = time.monotonic()
+                if await self.wait_for_opponent(): # not observed when kicked
+                    connect_phase.observe(time.monotonic() - start_time, "wait_for_opponent")
         except Exception as e:
             print(e)
 
+    # Rendezvous: the first player blocks on the 'go' list, the second one wakes it up.
+    # False if the player was kicked.
     async def wait_for_opponent(self):
+        ping_key = f"ping{self.game_id}"
+        go_key = f"go{self.game_id}"
+        start_time = time.monotonic()
         try:
-            key = f"ping{self.game_id}"
-            await self.redis_client.incr(key)
-            await self.redis_client.expire(key, self.WAITING_FOR_OPPONENT)
+            arrived = await self.redis_client.incr(ping_key)
+            await self.redis_client.expire(ping_key, self.WAITING_FOR_OPPONENT)
+            if arrived >= 2:
+                await self.redis_client.rpush(go_key, self.player_id)
+                await self.redis_client.expire(go_key, self.WAITING_FOR_OPPONENT)
+                print(f"{GREEN}Game {self.game_id}: joined waiting opponent in {time.monotonic() - start_time:.3f}s{RESET}")
+                return True
+            # holds its connection for up to WAITING_FOR_OPPONENT: not from the shared command pool
+            opponent = await redis_pool.client(blocking=True).blpop([go_key], timeout=self.WAITING_FOR_OPPONENT)
         except Exception as e:
+            print(e)
             await self.kick(message="Error while waiting for opponent")
-            return
-        start_time = time.time()
-        while time.time() - start_time < self.WAITING_FOR_OPPONENT:
-            try:
-                nb_players = await self.redis_client.get(key)
-            except Exception as e:
-                print(e)
-            if nb_players == '2':
-                return
-            await asleep(0.5)
-        await self.kick(message="No opponent found")
+            return False
+        if opponent is None:
+            await self.kick(message="No opponent found")
+            return False
+        print(f"{GREEN}Game {self.game_id}: opponent joined after {time.monotonic() - start_time:.3f}s{RESET}")
+        return True
 
     def get_user_infos(self):
         try:
@@ -95,37 +123,14 @@ class PongConsumer(AsyncWebsocketConsumer):
             print(e)
             return
 
-    def get_public_key(self):
-        try:
-            url = "https://nginx:8443/api/v1/auth/public-key/"
-            response = requests.get(
-                url,
-                timeout=10,
-                cert=("/etc/ssl/pong.crt", "/etc/ssl/pong.key"),
-                verify="/etc/ssl/ca.crt"
-            )
-
-            if response.status_code == 200:
-                self.public_key = response.json().get("public_key")
-            else:
-                raise RuntimeError("Impossible de récupérer la clé publique JWT")
-        except RuntimeError as e:
-            print(e)
-            raise(e)
-
-    async def join_redis_channels(self):
-        try:
-            REDIS_PASSWORD = settings.REDIS_PASSWORD
-
-            self.redis_client = await from_url(f"redis://:{REDIS_PASSWORD}@redis:6379", decode_responses=True)
-            
-            self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
-        except Exception as e:
-            raise Exception
-
     async def check_game_info(self):
-        # ask mmaking for expected players in game_id
         self.game_id = self.scope["url_route"]["kwargs"]["game_id"]
+        if await self.can_resume():
+            return True
+        ticket = parse_qs(self.scope.get("query_string", b"").decode()).get("ticket", [None])[0]
+        if ticket and settings.BACKEND_JWT["PUBLIC_KEY"]:
+            return await self.check_ticket(ticket)
+        # no ticket (older client): ask mmaking for expected players in game_id
         data = {"game_id": self.game_id}
         await self.redis_client.publish("info_mmaking", json.dumps(data))
         expected_players = None
@@ -150,6 +155,37 @@ class PongConsumer(AsyncWebsocketConsumer):
             return
         return True
 
+    # The checkpoint of a suspended game lists its players, no need for a ticket
+    # A game being played has a checkpoint too: a second socket of a player must not resume it.
+    async def can_resume(self):
+        deadline = time.monotonic() + SUSPEND_WAIT
+        while True:
+            state = await read_checkpoint(self.redis_client, self.game_id)
+            if state is None or self.player_id not in [player[0] for player in state["players"]]:
+                return False
+            if state.get("suspended"):
+                break
+            if time.monotonic() > deadline:
+                return False
+            await asleep(0.1)
+        self.resuming = True
+        return True
+
+    # ticket: signed by matchmaking when the game was made, see game_ticket() in listenredis.py
+    async def check_ticket(self, ticket):
+        try:
+            payload = jwt.decode(ticket, settings.BACKEND_JWT["PUBLIC_KEY"],
+                algorithms=[settings.BACKEND_JWT["ALGORITHM"]])
+        except jwt.InvalidTokenError as e:
+            await self.kick(message=f"{self.player_name}: Invalid game ticket ({e})")
+            return
+        if (payload.get("scope") != "game"
+            or str(payload.get("game_id")) != str(self.game_id)
+            or payload.get("player_id") != self.player_id):
+            await self.kick(message=f"{self.player_name}: Game ticket is not for this game")
+            return
+        return True
+
     # return True if user has sent more than MESSAGE_LIMIT in TIME_WINDOW seconds
     async def user_flooding(self):
         current_time = time.time()
@@ -170,19 +206,23 @@ class PongConsumer(AsyncWebsocketConsumer):
             return
         if await self.user_flooding():
             self.mute = True
+            flood_mutes.inc()
             return
         data = await self.load_valid_json(text_data)
         if not (data):
             return
+        if data["action"] == "move":
+            return await self.send_move(data)
         await self.channel_layer.group_send(
             self.room_group_name, {"type": "handle.message", "message": data}
         )
 
     async def kick(self, close_code=1008, message="Policy Violation"):
         print(RED, self.player_name, message, RESET)
-        await self.safe_send(json.dumps({"action": "disconnect"}))
+        await self.safe_send(DISCONNECT)
         if self.game != None:
-            await self.safe_send(json.dumps({"action": "game_cancelled"}))
+            await self.safe_send(GAME_CANCELLED)
+        await self.stop_game(drop=True, notify=True)
         self.connected = False
         await self.close(code=close_code)
 
@@ -202,6 +242,11 @@ class PongConsumer(AsyncWebsocketConsumer):
             if data["action"] == "move":
                 if data.get("key") not in (-1, 0, 1):
                     raise InvalidPacket(f"Invalid key value: {data.get('key')}")
+                # optional, sent by clients predicting their paddle
+                if not self.valid_int(data.setdefault("seq", None), 0xFFFF):
+                    raise InvalidPacket(f"Invalid seq value: {data.get('seq')}")
+                if not self.valid_int(data.setdefault("t", None), 0xFFFFFFFF):
+                    raise InvalidPacket(f"Invalid t value: {data.get('t')}")
                 return data
             if data["action"] == "load_complete":
                 if data.get("side") not in (0, 1):
@@ -212,6 +257,10 @@ class PongConsumer(AsyncWebsocketConsumer):
             print(f"{RED}Json error: {e} | data: {data}{RESET}")
             return None
 
+    @staticmethod
+    def valid_int(value, maximum):
+        return value is None or (type(value) is int and 0 <= value <= maximum)
+
     async def safe_send(self, data):
         try:
             await self.send(data)
@@ -226,7 +275,9 @@ class PongConsumer(AsyncWebsocketConsumer):
             return await self.moveplayer(data)
         if data["action"] == "load_complete":
             self.loaded[data['side']] = True
-            if self.master and self.game:
+            if self.master and self.loaded[0] and self.loaded[1] and simulation_is_remote():
+                await send_to_worker(self.channel_layer, self.game_id, {"type": "game.loaded"})
+            elif self.master and self.game:
                 self.game.loaded = self.loaded[0] and self.loaded[1]
             return
         if data["action"] == "init":
@@ -236,6 +287,19 @@ class PongConsumer(AsyncWebsocketConsumer):
         if data["action"] == "wannaplay!":
             return await self.wannaplay(data.get("id"), data.get("username"))
 
+    async def handle_frame(self, event):
+        try:
+            await self.send(bytes_data=event["frame"])
+        except Exception as e:
+            frames_dropped.inc("players")
+            print(f"{RED}Error while sending frame: {e}{RESET}")
+
+    # group message built with fanout.encoded(): forwarded without re-encoding it
+    async def send_encoded(self, event):
+        if not self.connected:
+            return
+        await self.safe_send(event["text"])
+
     async def wannaplay(self, opponent_id, opponent_name):
         self.nb_players += 1
         if self.player_id < opponent_id:
@@ -244,16 +308,19 @@ class PongConsumer(AsyncWebsocketConsumer):
             self.opponent_name = opponent_name
         if self.nb_players != 2 or not self.master:
             return
-        level_name = self.random_level_name()
-        self.game = Game(self.game_id, self.player_id, self.player_name, self.opponent_id, self.opponent_name, self, level_name)
-        json_data = {
+        self.level_name = self.random_level_name()
+        if not simulation_is_remote():
+            self.game = Game(self.game_id, self.player_id, self.player_name, self.opponent_id, self.opponent_name, self, self.level_name)
+        json_data = { # master player == player[0] == left player
             "action" : "init",
-            "dir" : self.game.ball_speed,
-            "lplayer": self.game.players[LEFT].name,
-            "rplayer": self.game.players[RIGHT].name,
-            "lpos":self.game.players[LEFT].pos,
-            "rpos":self.game.players[RIGHT].pos,
-            "level_name": level_name,
+            "dir" : STATS['initialBallSpeed'],
+            "lplayer": self.player_name,
+            "rplayer": self.opponent_name,
+            "lpos": 0,
+            "rpos": 0,
+            "level_name": self.level_name,
+            "lid": self.player_id,
+            "owner": self.channel_name,
         }
         await self.channel_layer.group_send(
             self.room_group_name, {"type": "handle.message", "message": json_data}
@@ -266,70 +333,186 @@ class PongConsumer(AsyncWebsocketConsumer):
         return level_name
 
     async def launch_game(self, data):
-        self.side = LEFT if self.master else RIGHT # master player == player[0] == left player
+        self.stop_waiting()
+        self.resuming = False
+        self.owner_channel = data.pop("owner", None)
+        self.master = self.owner_channel == self.channel_name
+        self.side = LEFT if data.pop("lid", None) == self.player_id else RIGHT
+        self.loaded = [False, False]
         data.update({ "side": str(self.side) })
         await self.safe_send(json.dumps(data))
         await self.channel_layer.group_send( # really useful ? Would be better to send rather than group_send
             self.room_group_name, {"type": "handle.message", "message": {"action": "ready"}}
         )
-        if self.master:
+        if self.master and simulation_is_remote() and data.get("resume"):
+            await send_to_worker(self.channel_layer, self.game_id, {"type": "game.resume", "group": self.room_group_name})
+        elif self.master and simulation_is_remote():
+            await send_to_worker(self.channel_layer, self.game_id, {
+                "type": "game.create",
+                "group": self.room_group_name,
+                "level_name": self.level_name,
+                "players": [[self.player_id, self.player_name], [self.opponent_id, self.opponent_name]],
+            })
+        elif self.master:
             self.task = create_task(self.game.play())
 
-    async def wait_a_bit(self, data):
-        time = data.get('time', 1)
-        await self.safe_send(json.dumps({"action":"wait", "time":time}))
+    # Inputs only go to whoever applies them: the worker, or the master consumer
+    # (directly if it lives in this process). The other consumer is never woken.
+    # An input that doesn't fit in a full channel is dropped: the next one replaces it.
+    async def send_move(self, data):
+        if self.side is None:
+            return # game not started yet
+        try:
+            if simulation_is_remote():
+                return await send_to_worker(self.channel_layer, self.game_id,
+                    {"type": "game.input", "side": data["side"], "key": data["key"], "seq": data["seq"], "t": data["t"]})
+            if self.master:
+                return await self.moveplayer(data)
+            owner = local_groups.consumer(self.owner_channel)
+            if owner is not None:
+                return await owner.moveplayer(data)
+            await self.channel_layer.send(self.owner_channel, {"type": "handle.message", "message": data})
+        except ChannelFull:
+            inputs_dropped.inc()
 
     async def moveplayer(self, message):
-        if self.master: # transmit move to game engine
-            self.game.players[message["side"]].move = message["key"]
+        if self.master and self.game: # transmit move to game engine
+            self.game.set_player_move(message["side"], message["key"], message.get("seq"), message.get("t"))
 
-    # client ws was closed, sending disconnection to other client
+    # client ws was closed: the game is suspended if it can be resumed, else cancelled
     async def disconnect(self, close_code):
         if not self.connected:
             return
         if self.room_group_name:
-            await self.channel_layer.group_send(
-                self.room_group_name, {"type": "disconnect.now"})
+            resumable = await self.game_is_resumable()
+            if resumable:
+                message = {"type": "player.left", "player_id": self.player_id}
+            else:
+                message = {"type": "disconnect.now"}
+            await self.channel_layer.group_send(self.room_group_name, message)
+            return await self.cleanup(drop=not resumable)
         await self.cleanup()
 
+    async def game_is_resumable(self):
+        try:
+            return await read_checkpoint(self.redis_client, self.game_id) is not None
+        except Exception as e:
+            print(f"{RED}Could not read checkpoint of game {self.game_id}: {e}{RESET}")
+            return False
+
+    async def player_left(self, event):
+        if not self.connected:
+            return
+        if event["player_id"] == self.player_id:
+            if self.resuming: # our previous socket: the game is only suspended now
+                await self.announce_rejoin()
+            return
+        if self.grace_task is not None:
+            return
+        await self.stop_game()
+        await self.safe_send(json.dumps({"action": "opponent_left", "grace": GRACE_PERIOD}))
+        self.grace_task = create_task(self.wait_for_rejoin())
+
+    async def rejoin(self):
+        self.grace_task = create_task(self.wait_for_rejoin())
+        await self.announce_rejoin()
+
+    async def announce_rejoin(self):
+        await self.channel_layer.group_send(
+            self.room_group_name, {"type": "player.rejoined", "player_id": self.player_id})
+
+    # Both players are back: the first one to take the lease resumes the game and owns it.
+    async def player_rejoined(self, event):
+        if not self.connected or event["player_id"] == self.player_id or self.grace_task is None:
+            return
+        owner = worker_channel(self.game_id) if simulation_is_remote() else self.channel_name
+        if not await take_lease(self.redis_client, self.game_id, owner):
+            return # the other player resumes it, its init is coming
+        state = await read_checkpoint(self.redis_client, self.game_id)
+        if state is None:
+            return await self.kick(message="Checkpoint expired")
+        print(f"{GREEN}Game {self.game_id}: resumed by {self.player_name}{RESET}")
+        (left_id, left_name, *_), (_, right_name, *_) = state["players"]
+        self.level_name = state["level_name"]
+        if not simulation_is_remote():
+            self.game = Game.from_checkpoint(self.game_id, state, self)
+        json_data = {
+            "action" : "init",
+            "resume": True,
+            "dir" : STATS['initialBallSpeed'],
+            "lplayer": left_name,
+            "rplayer": right_name,
+            "lpos": 0,
+            "rpos": 0,
+            "level_name": self.level_name,
+            "lid": left_id,
+            "owner": self.channel_name,
+        }
+        await self.channel_layer.group_send(
+            self.room_group_name, {"type": "handle.message", "message": json_data}
+        )
+
+    async def wait_for_rejoin(self):
+        await asleep(GRACE_PERIOD)
+        self.grace_task = None
+        print(f"{YELLOW}Game {self.game_id}: opponent of {self.player_name} did not come back{RESET}")
+        try:
+            # nobody runs the game (else the lease would be taken): drop it for good
+            if await take_lease(self.redis_client, self.game_id, self.channel_name, timeout=0):
+                await delete_checkpoint(self.redis_client, self.game_id)
+                spectator_feed.close(self.game_id, {"action": "game_cancelled"})
+        except Exception as e:
+            print(f"{RED}Could not delete checkpoint of game {self.game_id}: {e}{RESET}")
+        await self.safe_send(GAME_CANCELLED)
+        await self.safe_send(DISCONNECT)
+
+    def stop_waiting(self):
+        if self.grace_task is not None:
+            self.grace_task.cancel()
+            self.grace_task = None
+
     async def disconnect_now(self, event):
         if not self.connected:
             return
-        if not event.get("from"):
-            await self.safe_send(json.dumps({"action": "game_cancelled"}))
-        await self.safe_send(json.dumps({"action": "disconnect"}))
+        await self.stop_game(drop=True)
+        await self.safe_send(GAME_CANCELLED)
+        await self.safe_send(DISCONNECT)
 
-    async def cleanup(self):
+    async def cleanup(self, drop=False):
         self.connected = False
+        self.stop_waiting()
+        local_groups.discard(self.room_group_name, self)
         try:
             await self.channel_layer.group_discard(self.room_group_name, self.channel_name)
-            if self.pubsub:
-                self.pubsub.unsubscribe()
-                await self.pubsub.close()
-                self.pubsub = None
-            if self.redis_client:
-                await self.redis_client.close()
-                self.redis_client = None
         except Exception as e:
             print(f"Erreur lors de la fermeture Redis : {e}")
-        if self.master:
-            self.game = None
-            if self.task and not self.task.done():
-                self.task.cancel()
+        await self.stop_game(drop)
+
+    # The game is checkpointed when it stops (see Game.suspend), then resumed or dropped.
+    # drop: it won't be resumed (see Game.drop). notify: the worker tells the players.
+    async def stop_game(self, drop=False, notify=False):
+        if not self.master:
+            return
+        if self.level_name and simulation_is_remote():
             try:
-                await self.task
-            except CancelledError:
-                pass
+                await send_to_worker(self.channel_layer, self.game_id, {"type": "game.cancel", "drop": drop, "notify": notify})
+            except Exception as e:
+                print(f"{RED}Could not cancel game {self.game_id} on its worker: {e}{RESET}")
+        if self.game is not None:
+            self.game.dropped = drop
+        self.game = None
+        if self.task is None:
+            return
+        if not self.task.done():
+            self.task.cancel()
+        try:
+            await self.task
+        except CancelledError:
+            pass
+        self.task = None
 
 
 
     async def send_score(self):
         score = self.game.get_score()
         await self.redis_client.publish("info_mmaking", json.dumps(score))
-
-    async def declare_winner(self, event):
-        await self.safe_send(json.dumps({
-            "action": "game_won",
-            "winner": event["winner"],
-            "scores": event["scores"],
-        }))
@@ -0,0 +1,47 @@
+import json
+from channels.generic.websocket import AsyncWebsocketConsumer #type: ignore
+from .spectate import spectator_hub
+from .const import RESET, RED, YELLOW
+
+DISCONNECT = json.dumps({"action": "disconnect"})
+
+
+class SpectatorConsumer(AsyncWebsocketConsumer):
+    """Read-only game socket. Frames come from the SpectatorHub of this process,
+    not from the channel layer, and anything the client sends is ignored."""
+
+    async def connect(self):
+        self.game_id = self.scope["url_route"]["kwargs"]["game_id"]
+        self.watching = False
+        payload = self.scope["payload"]
+        if not payload:
+            await self.close(code=1008)
+            return
+        await self.accept()
+        try:
+            await spectator_hub.add(self.game_id, self)
+            self.watching = True
+            print(f"{YELLOW}{payload.get('username')} watches game {self.game_id}{RESET}")
+        except Exception as e:
+            print(f"{RED}Spectator could not join game {self.game_id}: {e}{RESET}")
+            await self.close(code=1011)
+
+    async def receive(self, text_data=None, bytes_data=None):
+        pass
+
+    async def send_spectated(self, text_data=None, bytes_data=None, last=False):
+        """last: the game is over, nothing else will come"""
+        try:
+            await self.send(text_data=text_data, bytes_data=bytes_data)
+            if last:
+                await self.send(text_data=DISCONNECT)
+        except Exception as e:
+            print(f"{RED}Error while sending to spectator: {e}{RESET}")
+        if last:
+            await self.disconnect(None)
+            await self.close()
+
+    async def disconnect(self, close_code):
+        if self.watching:
+            self.watching = False
+            await spectator_hub.discard(self.game_id, self)
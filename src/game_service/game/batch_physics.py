@@ -0,0 +1,199 @@
+# Struct-of-arrays version of the Game / Player / bounce physics.
+# Keeps every active game in NumPy arrays and steps them all at once.
+# Must give the same results as the scalar code, see `benchphysics --check`.
+
+import numpy as np
+from .const import LEFT, RIGHT, DELTATIME, STATS
+from .bounce import RAD90, RAD180, RAD360, X_AXIS, Y_AXIS, MAX_BOUNCES_PER_TICK
+
+
+class BatchPhysics:
+
+    def __init__(self, capacity=64):
+        self.size = 0
+        self.free = []
+        self.allocate(capacity)
+
+    def allocate(self, capacity):
+        old = self.__dict__.get('ball_pos')
+        self.capacity = capacity
+        arrays = {
+            'active': np.zeros(capacity, dtype=bool),
+            'half_board': np.ones((capacity, 2)),
+            'ball_pos': np.zeros((capacity, 2)),
+            'ball_dir': np.zeros((capacity, 2)),
+            'ball_speed': np.zeros(capacity),
+            'pad_pos': np.zeros((capacity, 2)),
+            'pad_size': np.zeros((capacity, 2)),
+            'pad_move': np.zeros((capacity, 2)),
+            'pad_speed': np.zeros(capacity),
+            'round_start_mult': np.ones(capacity),
+        }
+        for name, array in arrays.items():
+            if old is not None:
+                array[:self.size] = getattr(self, name)[:self.size]
+            setattr(self, name, array)
+
+    # MARK: Slots
+
+    def add(self, game=None):
+        """Reserve a slot (optionally filled from a Game) and return its index."""
+        if self.free:
+            slot = self.free.pop()
+        else:
+            if self.size == self.capacity:
+                self.allocate(self.capacity * 2)
+            slot = self.size
+            self.size += 1
+        self.active[slot] = True
+        if game is not None:
+            self.load(slot, game)
+        return slot
+
+    def remove(self, slot):
+        self.active[slot] = False
+        self.free.append(slot)
+
+    def load(self, slot, game):
+        """Copy a Game's state into slot."""
+        self.half_board[slot] = [game.level["board_size"][0] / 2, game.level["board_size"][1] / 2]
+        self.ball_pos[slot] = game.ball_pos
+        self.ball_dir[slot] = game.ball_direction
+        self.ball_speed[slot] = game.ball_speed
+        self.pad_pos[slot] = [game.players[LEFT].pos, game.players[RIGHT].pos]
+        self.pad_size[slot] = [game.players[LEFT].pad_size, game.players[RIGHT].pad_size]
+        self.pad_move[slot] = [game.players[LEFT].move, game.players[RIGHT].move]
+        self.pad_speed[slot] = game.pad_speed
+        self.round_start_mult[slot] = game.round_start_mult
+
+    def store(self, slot, game):
+        """Copy slot back into a Game."""
+        game.ball_pos = self.ball_pos[slot].tolist()
+        game.ball_direction = self.ball_dir[slot].tolist()
+        game.ball_speed = float(self.ball_speed[slot])
+        game.pad_speed = float(self.pad_speed[slot])
+        game.round_start_mult = int(self.round_start_mult[slot])
+        for side in (LEFT, RIGHT):
+            game.players[side].pos = float(self.pad_pos[slot, side])
+            game.players[side].pad_size = float(self.pad_size[slot, side])
+
+    def set_player_move(self, slot, side, move):
+        self.pad_move[slot, side] = int(move)
+
+    # MARK: Simulation
+
+    def step(self, mask=None):
+        """Advance the selected games (default: all active) by DELTATIME.\n
+        Returns an int array, per slot: side that missed the ball, or -1."""
+        if mask is None:
+            mask = self.active
+        self.move_players(mask)
+        return self.move_ball(mask)
+
+    def move_players(self, mask):
+        half_height = self.half_board[:, 1:2]
+        is_too_low = self.pad_pos <= -half_height
+        is_too_high = self.pad_pos >= half_height
+        moving = (((self.pad_move < 0) & ~is_too_low) | ((self.pad_move > 0) & ~is_too_high)) & mask[:, None]
+        step = self.pad_move * self.pad_speed[:, None] * DELTATIME
+        self.pad_pos = np.where(moving, self.pad_pos + step, self.pad_pos)
+
+    def move_ball(self, mask):
+        """Same swept collisions as Game.move_ball, every game moves edge to edge in lockstep."""
+        remaining = np.where(mask, DELTATIME, 0.0)
+        result = np.full(self.capacity, -1)
+        active = mask.copy()
+        for _ in range(MAX_BOUNCES_PER_TICK):
+            if not active.any():
+                break
+            time, axis = time_of_impact(self.ball_pos, self.ball_dir, self.ball_speed, self.half_board)
+            hit = active & (time <= remaining)
+            step = np.where(hit, time, np.where(active, remaining, 0.0))
+            self.ball_pos[:, 0] += step * self.ball_dir[:, 0] * self.ball_speed
+            self.ball_pos[:, 1] += step * self.ball_dir[:, 1] * self.ball_speed
+            remaining = remaining - step
+            active = hit
+            if not active.any():
+                break
+
+            # snap to the edge
+            for snap_axis in (X_AXIS, Y_AXIS):
+                snap = active & (axis == snap_axis)
+                edge = np.where(self.ball_dir[:, snap_axis] > 0, self.half_board[:, snap_axis], -self.half_board[:, snap_axis])
+                self.ball_pos[:, snap_axis] = np.where(snap, edge, self.ball_pos[:, snap_axis])
+
+            # top / bottom collision
+            wall = active & (axis == Y_AXIS)
+            self.ball_dir[:, 1] = np.where(wall, -self.ball_dir[:, 1], self.ball_dir[:, 1])
+
+            # left / right collision
+            index = np.nonzero(active & (axis == X_AXIS))[0]
+            if not index.size:
+                continue
+            hit_side = np.where(self.ball_dir[index, 0] > 0, LEFT, RIGHT)
+            paddle_pos = self.pad_pos[index, hit_side]
+            paddle_size = self.pad_size[index, hit_side]
+            ball_y = self.ball_pos[index, 1]
+            missed = (ball_y < paddle_pos - paddle_size / 2) | (ball_y > paddle_pos + paddle_size / 2)
+
+            bounced = ~missed
+            if bounced.any():
+                self.ball_dir[index[bounced]] = bounce(
+                    self.ball_dir[index[bounced]], self.ball_pos[index[bounced]],
+                    paddle_pos[bounced], paddle_size[bounced],
+                    hit_side[bounced]
+                )
+            result[index[missed]] = hit_side[missed]
+            active[index[missed]] = False
+        return result
+
+    def new_round(self, slots, missed_sides):
+        """Same as Game.new_round (minus the network part) for every slot in slots."""
+        self.round_start_mult[slots] = np.where(missed_sides == RIGHT, -1, 1)
+        self.ball_pos[slots] = 0
+        self.ball_dir[slots, 0] = 0.7071067811865475 * self.round_start_mult[slots]
+        self.ball_dir[slots, 1] = 0.7071067811865475
+        self.pad_pos[slots] = 0
+        self.ball_speed[slots] *= STATS['ballAccelerateFactor']
+        self.pad_speed[slots] *= STATS['padAccelerateFactor']
+        self.pad_size[slots, LEFT] *= STATS['padShrinkFactor']
+        self.pad_size[slots, RIGHT] = self.pad_size[slots, LEFT]
+
+
+def time_of_impact(ball_pos, ball_direction, ball_speed, half_board):
+    """Vectorized bounce.time_of_impact(), one row per ball."""
+    times = np.full(ball_pos.shape, np.inf)
+    with np.errstate(divide='ignore', invalid='ignore'):
+        for axis in (X_AXIS, Y_AXIS):
+            velocity = ball_direction[:, axis] * ball_speed
+            times[:, axis] = np.where(velocity > 0, (half_board[:, axis] - ball_pos[:, axis]) / velocity,
+                np.where(velocity < 0, (-half_board[:, axis] - ball_pos[:, axis]) / velocity, np.inf))
+    axis = np.where(times[:, X_AXIS] <= times[:, Y_AXIS], X_AXIS, Y_AXIS)
+    time = np.maximum(np.where(axis == X_AXIS, times[:, X_AXIS], times[:, Y_AXIS]), 0.0)
+    return time, axis
+
+
+def bounce(ball_direction, ball_pos, paddle_pos, paddle_size, collision_side):
+    """Vectorized bounce.bounce(), one row per ball."""
+    signed_side = np.where(collision_side == LEFT, 1.0, -1.0)
+    max_angle_rad = np.radians(STATS["maxAngleDeg"])
+
+    hit_position = -1.0 + (ball_pos[:, 1] - (paddle_pos - paddle_size / 2)) / paddle_size * 2.0
+
+    angle = np.arctan2(-ball_direction[:, 1], -ball_direction[:, 0]) + np.pi
+    angle = np.where(angle > RAD180,
+        -signed_side * (np.where(collision_side == LEFT, RAD360, RAD180) - angle),
+        angle)
+    angle = np.where(angle > RAD90, RAD90 - (angle - RAD90), angle)
+
+    angle = np.clip(angle, -max_angle_rad, max_angle_rad)
+
+    redirection = hit_position * STATS["redirectionFactor"]
+
+    new_angle = np.clip(angle + redirection, -max_angle_rad, max_angle_rad)
+
+    rad = new_angle * signed_side
+    new_direction = np.empty_like(ball_direction)
+    new_direction[:, 0] = np.abs(signed_side * np.cos(rad)) * -signed_side
+    new_direction[:, 1] = signed_side * np.sin(rad)
+    return new_direction
@@ -1,7 +1,7 @@
 # separate file to not complicate Game.py
 
 from .const import STATS
-from math import pi, degrees, radians, cos, sin, atan2
+from math import pi, degrees, radians, cos, sin, atan2, inf
 
 
 RAD90  = pi * 0.5
@@ -9,6 +9,12 @@ RAD180 = pi * 1.0
 RAD270 = pi * 1.5
 RAD360 = pi * 2.0
 
+X_AXIS = 0
+Y_AXIS = 1
+
+# Above that, the rest of the tick is dropped (should never happen in a real game)
+MAX_BOUNCES_PER_TICK = 8
+
 
 def bounce(ball_direction, ball_pos, paddle_pos, paddle_size, collision_side):
 	signed_side = 1 if collision_side == 0 else -1
@@ -38,6 +44,20 @@ def bounce(ball_direction, ball_pos, paddle_pos, paddle_size, collision_side):
 	return new_direction
 
 
+def time_of_impact(ball_pos, ball_direction, ball_speed, half_board):
+	"""Time until the ball reaches the edge of the board, and the axis of that edge.
+	Left/right edges (X_AXIS) are where the paddles are, top/bottom (Y_AXIS) are walls."""
+	times = [inf, inf]
+	for axis in (X_AXIS, Y_AXIS):
+		velocity = ball_direction[axis] * ball_speed
+		if velocity > 0:
+			times[axis] = (half_board[axis] - ball_pos[axis]) / velocity
+		elif velocity < 0:
+			times[axis] = (-half_board[axis] - ball_pos[axis]) / velocity
+	axis = X_AXIS if times[X_AXIS] <= times[Y_AXIS] else Y_AXIS
+	return max(times[axis], 0.0), axis
+
+
 def map(input, in_min, in_max, out_min, out_max):
 	return out_min + (input - in_min) / (in_max - in_min) * (out_max - out_min)
 
@@ -0,0 +1,64 @@
+# Game checkpoints: a dropped socket pauses the match instead of cancelling it.
+#
+# The process running a game (master consumer or game worker) holds the owner
+# lease of the game, and writes the state of the current round to redis every
+# CHECKPOINT_INTERVAL seconds, renewing the lease at the same time. When a player
+# leaves, the game is stopped, checkpointed one last time, and the lease released.
+#
+# The players still connected wait GRACE_PERIOD seconds. When the one who left
+# reconnects, on any game_service process, the first to take the lease rebuilds
+# the Game from the checkpoint and becomes its owner. The interrupted rally is
+# replayed from its start: the checkpoint is taken when the round starts.
+#
+# Only a suspended game can be resumed: the last checkpoint is marked
+# "suspended", the ones written during the play are not.
+#
+#   game_{id}_checkpoint  json, see Game.round_state()
+#   game_{id}_owner       channel name of the owner, expires after LEASE_TTL
+
+import json
+from time import monotonic
+from asyncio import sleep as asleep
+
+CHECKPOINT_INTERVAL = 1 # seconds
+CHECKPOINT_TTL = 60 # seconds, the checkpoint outlives a suspended game by that much at most
+GRACE_PERIOD = 20 # seconds for a player to come back before the game is cancelled
+LEASE_TTL = 5 # seconds, a crashed owner is replaced after that
+SUSPEND_WAIT = 3 # seconds, a player reconnecting at once may arrive before the game is suspended
+
+
+def checkpoint_key(game_id):
+    return f"game_{game_id}_checkpoint"
+
+
+def lease_key(game_id):
+    return f"game_{game_id}_owner"
+
+
+async def write_checkpoint(redis_client, game_id, state, owner):
+    await redis_client.set(checkpoint_key(game_id), json.dumps(state), ex=CHECKPOINT_TTL)
+    await redis_client.set(lease_key(game_id), owner, ex=LEASE_TTL)
+
+
+async def read_checkpoint(redis_client, game_id):
+    data = await redis_client.get(checkpoint_key(game_id))
+    return json.loads(data) if data else None
+
+
+async def delete_checkpoint(redis_client, game_id):
+    await redis_client.delete(checkpoint_key(game_id), lease_key(game_id))
+
+
+async def take_lease(redis_client, game_id, owner, timeout=LEASE_TTL):
+    """Wait until the previous owner released the game (or its lease expired), then own it."""
+    deadline = monotonic() + timeout
+    while not await redis_client.set(lease_key(game_id), owner, ex=LEASE_TTL, nx=True):
+        if monotonic() > deadline:
+            return False
+        await asleep(0.1)
+    return True
+
+
+async def release_lease(redis_client, game_id, owner):
+    if await redis_client.get(lease_key(game_id)) == owner:
+        await redis_client.delete(lease_key(game_id))
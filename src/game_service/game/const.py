@@ -11,8 +11,15 @@ LEFT = 0
 RIGHT = 1
 
 
-FPS = 60
-DELTATIME = 1.0 / FPS
+# Physics steps per second, and game-state frames sent to the clients per second.
+# The clients interpolate between frames, see WebGame.js
+SIMULATION_HZ = 120
+SNAPSHOT_HZ = 30
+DELTATIME = 1.0 / SIMULATION_HZ
+SNAPSHOT_INTERVAL = SIMULATION_HZ // SNAPSHOT_HZ # ticks
+# Spectators get keyframes only, at a lower rate, see spectate.py
+SPECTATOR_HZ = 10
+SPECTATOR_INTERVAL = SIMULATION_HZ // SPECTATOR_HZ # ticks
 
 # Controls how the game runs.
 # Should be (manually) kept in sync with LocalGame.js
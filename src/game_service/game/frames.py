@@ -0,0 +1,115 @@
+# Binary game-state frames, sent to the clients as websocket bytes_data.
+# Must be kept in sync with decodeFrame() in WebGame.js
+#
+# Layout (little endian):
+#   u8  version
+#   u8  flags       which fields follow, see below
+#   u32 sequence    frame number, per game
+#   u32 time        game time of the frame, in milliseconds
+#   2 x u16 acks    last input sequence number applied, left and right player
+#   then, for each flag set, in this order:
+#   BALL      2 x f32   ball position
+#   BALL_DIR  2 x f32   ball direction
+#   LPOS      f32       left paddle position
+#   RPOS      f32       right paddle position
+#   SIZE      3 x f32   paddle sizes, paddle speed
+#   SCORES    2 x u8    left and right scores
+#
+# A keyframe contains every field. Other frames (deltas) only contain the
+# fields that changed since the previous frame: a client that missed a frame
+# (a gap in the sequence) must wait for the next keyframe.
+# RESYNC marks a discontinuity (new round, end of a pause): clients must not
+# interpolate between this frame and the previous ones.
+#
+# The acks let each client find which of its inputs the frame already contains,
+# to predict its own paddle and reconcile it with the frames (see WebGame.js).
+
+from struct import Struct, pack_into
+from .const import LEFT, RIGHT, SNAPSHOT_HZ
+
+FRAME_VERSION = 3
+
+BALL = 1 << 0
+BALL_DIR = 1 << 1
+LPOS = 1 << 2
+RPOS = 1 << 3
+SIZE = 1 << 4
+SCORES = 1 << 5
+RESYNC = 1 << 6
+KEYFRAME = 1 << 7
+
+HEADER = Struct("<BBIIHH")
+FIELDS = ( # (flag, struct), in wire order
+    (BALL, Struct("<2f")),
+    (BALL_DIR, Struct("<2f")),
+    (LPOS, Struct("<f")),
+    (RPOS, Struct("<f")),
+    (SIZE, Struct("<3f")),
+    (SCORES, Struct("<2B")),
+)
+MAX_FRAME_SIZE = HEADER.size + sum(field.size for _, field in FIELDS)
+
+# f32 rounding, so that deltas compare what the client would actually see
+_F32 = Struct("<f")
+def _f32(value):
+    return _F32.unpack(_F32.pack(value))[0]
+
+
+class FrameEncoder:
+    """Builds the frames of one game. Keeps the last sent values to make deltas."""
+
+    KEYFRAME_INTERVAL = SNAPSHOT_HZ # frames
+
+    def __init__(self):
+        self.sequence = 0
+        self.previous = None
+
+    def values(self, game):
+        return {
+            BALL: (_f32(game.ball_pos[0]), _f32(game.ball_pos[1])),
+            BALL_DIR: (_f32(game.ball_direction[0]), _f32(game.ball_direction[1])),
+            LPOS: (_f32(game.players[LEFT].pos),),
+            RPOS: (_f32(game.players[RIGHT].pos),),
+            SIZE: (_f32(game.players[LEFT].pad_size), _f32(game.players[RIGHT].pad_size), _f32(game.pad_speed)),
+            SCORES: (game.players[LEFT].score, game.players[RIGHT].score),
+        }
+
+    def encode(self, game, keyframe=False, resync=False):
+        values = self.values(game)
+        keyframe = (keyframe or self.previous is None
+            or self.sequence % self.KEYFRAME_INTERVAL == 0)
+        flags = KEYFRAME if keyframe else 0
+        if resync:
+            flags |= RESYNC
+        buffer = bytearray(MAX_FRAME_SIZE)
+        offset = HEADER.size
+        for flag, field in FIELDS:
+            if keyframe or values[flag] != self.previous[flag]:
+                flags |= flag
+                pack_into(field.format, buffer, offset, *values[flag])
+                offset += field.size
+        HEADER.pack_into(buffer, 0, FRAME_VERSION, flags, self.sequence, game.time_ms & 0xFFFFFFFF,
+            game.players[LEFT].last_input, game.players[RIGHT].last_input)
+        self.sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self.previous = values
+        return bytes(buffer[:offset])
+
+
+def decode_frame(data, state=None):
+    """Python decoder, mirror of decodeFrame() in WebGame.js. Returns the updated state dict."""
+    version, flags, sequence, time, left_ack, right_ack = HEADER.unpack_from(data, 0)
+    if version != FRAME_VERSION:
+        raise ValueError(f"Unsupported frame version {version}")
+    if not flags & KEYFRAME and (state is None or state.get("sequence") != (sequence - 1) & 0xFFFFFFFF):
+        raise ValueError(f"Frame {sequence} is a delta without its previous frame")
+    state = {} if (state is None or flags & KEYFRAME) else dict(state)
+    state["sequence"] = sequence
+    state["time"] = time
+    state["acks"] = (left_ack, right_ack)
+    state["resync"] = bool(flags & RESYNC)
+    offset = HEADER.size
+    for flag, field in FIELDS:
+        if flags & flag:
+            state[flag] = field.unpack_from(data, offset)
+            offset += field.size
+    return state
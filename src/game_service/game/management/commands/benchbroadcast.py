@@ -0,0 +1,71 @@
+import json
+from time import perf_counter
+from django.core.management.base import BaseCommand
+from ...Game import Game
+from ...frames import FrameEncoder
+from ...fanout import encoded
+from ...const import LEVELS, GREEN, RESET
+from .benchphysics import NoNetwork
+
+
+class Command(BaseCommand):
+    help = "Serialization CPU per broadcast frame: JSON per consumer, JSON encoded once, binary frame"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--frames", type=int, default=20000)
+        parser.add_argument("--recipients", type=int, default=2,
+            help="Consumers receiving each frame (2 players, more with spectators)")
+
+    def handle(self, *args, **options):
+        try:
+            import msgpack #type: ignore
+        except ImportError:
+            msgpack = None
+        self.msgpack = msgpack
+        count, recipients = options["frames"], options["recipients"]
+        game = Game(0, 1, "left", 2, "right", NoNetwork(), next(iter(LEVELS)))
+        game.replay = None
+        self.encoder = FrameEncoder()
+
+        results = {
+            "json per consumer": self.bench(game, count, lambda: self.per_consumer(game, recipients)),
+            "json encoded once": self.bench(game, count, lambda: self.once(game, recipients)),
+            "binary frame":      self.bench(game, count, lambda: self.binary(game, recipients)),
+        }
+        print(f"{count} frames, {recipients} recipients, channel layer: {'msgpack' if msgpack else 'not measured (no msgpack)'}")
+        baseline = results["json per consumer"]
+        for name, seconds in results.items():
+            per_frame = seconds / count * 1e6
+            print(f"{name:18} {per_frame:8.2f} us/frame  {per_frame / recipients:8.2f} us/recipient  x{baseline / seconds:.1f}")
+        print(f"{GREEN}binary frames: {len(FrameEncoder().encode(game, keyframe=True))} bytes per keyframe, "
+            f"json: {len(json.dumps(game.get_game_state()))} bytes{RESET}")
+
+    def bench(self, game, count, send):
+        start = perf_counter()
+        for i in range(count):
+            # move the ball, so that nothing can be cached between frames
+            game.ball_pos[0] = (i % 100) / 100
+            send()
+        return perf_counter() - start
+
+    def layer(self, message, recipients):
+        """What channels_redis does: one msgpack per recipient channel"""
+        if self.msgpack:
+            for _ in range(recipients):
+                self.msgpack.packb(message, use_bin_type=True)
+
+    def per_consumer(self, game, recipients):
+        # before: the state goes through the layer as a dict, each consumer dumps it
+        message = {"type": "handle.message", "message": game.get_game_state()}
+        self.layer(message, recipients)
+        for _ in range(recipients):
+            json.dumps(message["message"])
+
+    def once(self, game, recipients):
+        message = encoded(game.get_game_state())
+        self.layer(message, recipients)
+
+    def binary(self, game, recipients):
+        message = {"type": "handle.frame", "frame": self.encoder.encode(game)}
+        self.layer(message, recipients)
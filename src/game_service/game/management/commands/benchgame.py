@@ -0,0 +1,197 @@
+import json
+from asyncio import run as arun, create_task, gather, wait_for, sleep as asleep, TimeoutError as AsyncTimeoutError, CancelledError
+from collections import deque
+from random import Random
+from statistics import mean, pstdev
+from time import perf_counter
+import tracemalloc
+from channels.consumer import get_handler_name #type: ignore
+from channels.layers import InMemoryChannelLayer #type: ignore
+from django.core.management.base import BaseCommand
+from ...Game import Game
+from ...scheduler import scheduler
+from ...fanout import local_groups
+from ...const import LEFT, RIGHT, LEVELS, SNAPSHOT_HZ, GREEN, YELLOW, RESET
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+class NoRedis:
+    """Stand-in for the consumer's redis client: replays, checkpoints and scores go nowhere."""
+
+    async def get(self, *args, **kwargs):
+        return None
+
+    async def set(self, *args, **kwargs):
+        pass
+
+    async def publish(self, *args, **kwargs):
+        pass
+
+    async def delete(self, *args, **kwargs):
+        pass
+
+
+class NoFeed:
+    """Stand-in for the spectator feed, counts the frames it would publish."""
+
+    def __init__(self):
+        self.frames = 0
+
+    def open(self, game):
+        pass
+
+    def publish(self, game_id, frame):
+        self.frames += 1
+
+    def pause(self, game_id, message):
+        pass
+
+    def close(self, game_id, message):
+        pass
+
+
+class BenchClient:
+    """Receives what a PongConsumer would, and counts it instead of writing to a socket."""
+
+    def __init__(self, stats):
+        self.stats = stats
+        self.last_frame = None
+
+    async def handle_frame(self, event):
+        now = perf_counter()
+        if self.last_frame is not None:
+            self.stats["intervals"].append(now - self.last_frame)
+        self.last_frame = now
+        self.stats["frames"] += 1
+        self.stats["bytes"] += len(event["frame"])
+        self.stats["messages"] += 1
+
+    async def send_encoded(self, event):
+        if json.loads(event["text"]).get("action") == "wait":
+            self.last_frame = None # the pause is not jitter
+        self.stats["messages"] += 1
+
+
+class BenchHandle:
+    """Stand-in for the master PongConsumer of one game (Game.wsh)."""
+
+    def __init__(self, game_id, channel_layer):
+        self.channel_layer = channel_layer
+        self.room_group_name = f"game_{game_id}"
+        self.channel_name = f"bench_{game_id}"
+        self.redis_client = NoRedis()
+
+    async def send_score(self):
+        pass
+
+
+class Command(BaseCommand):
+    help = "Run N games through the scheduler with synthetic players, without redis nor postgres"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--games", type=int, default=200)
+        parser.add_argument("--duration", type=float, default=10.0,
+            help="Seconds of play, unfinished games are cancelled after that")
+        parser.add_argument("--inputs", type=float, default=4.0,
+            help="Input changes per player per second")
+        parser.add_argument("--layer", action="store_true",
+            help="Go through the in-memory channel layer instead of the local fast path")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        arun(self.bench(options))
+
+    async def bench(self, options):
+        count = options["games"]
+        rng = Random(options["seed"])
+        channel_layer = InMemoryChannelLayer(capacity=1000)
+        stats = {"frames": 0, "bytes": 0, "messages": 0, "intervals": []}
+        feed = NoFeed()
+
+        tracemalloc.start()
+        before = tracemalloc.get_traced_memory()[0]
+        level_name = next(iter(LEVELS))
+        games = []
+        for i in range(count):
+            game = Game(i, 2 * i + 1, f"left{i}", 2 * i + 2, f"right{i}", BenchHandle(i, channel_layer), level_name)
+            game.round_start_mult = rng.choice([1, -1])
+            game.recenter()
+            game.loaded = True
+            games.append(game)
+        memory_per_game = (tracemalloc.get_traced_memory()[0] - before) / count
+        tracemalloc.stop()
+
+        receivers = []
+        for game in games:
+            for _ in (LEFT, RIGHT):
+                client = BenchClient(stats)
+                if options["layer"]:
+                    receivers.append(create_task(self.receive(channel_layer, game.wsh.room_group_name, client)))
+                else:
+                    local_groups.add(game.wsh.room_group_name, client)
+        await asleep(0) # let the receivers join their group
+
+        scheduler.recent_durations = deque() # keep every tick of the run
+        ticks, overruns, dropped = scheduler.ticks, scheduler.overruns, scheduler.dropped_ticks
+        driver = create_task(self.players(games, options["inputs"], rng))
+        start = perf_counter()
+        plays = [create_task(game.play(feed=feed)) for game in games]
+        try:
+            await wait_for(gather(*plays), options["duration"])
+        except AsyncTimeoutError:
+            pass
+        elapsed = perf_counter() - start
+        for task in (driver, *receivers):
+            task.cancel()
+        await gather(driver, *receivers, return_exceptions=True)
+        for game in games:
+            local_groups.groups.pop(game.wsh.room_group_name, None)
+
+        finished = sum(game.over for game in games)
+        durations = [d * 1000 for d in scheduler.recent_durations]
+        deviations = [abs(i - 1 / SNAPSHOT_HZ) * 1000 for i in stats["intervals"]]
+        intervals = [i * 1000 for i in stats["intervals"]]
+        budget = scheduler.deltatime * 1000
+        overruns = scheduler.overruns - overruns
+
+        print(f"{count} games for {elapsed:.1f}s ({finished} finished), {'channel layer' if options['layer'] else 'local fast path'}")
+        print(f"ticks:    {scheduler.ticks - ticks}, {overruns} overruns, {scheduler.dropped_ticks - dropped} dropped")
+        print(f"tick ms:  p50 {percentile(durations, 50):.3f}  p90 {percentile(durations, 90):.3f}  "
+            f"p99 {percentile(durations, 99):.3f}  max {max(durations, default=0):.3f}  (budget {budget:.3f})")
+        if intervals:
+            print(f"frames:   every {mean(intervals):.2f}ms (expected {1000 / SNAPSHOT_HZ:.2f}), "
+                f"stddev {pstdev(intervals):.2f}ms, p99 jitter {percentile(deviations, 99):.2f}ms")
+        print(f"messages: {stats['messages'] / elapsed:,.0f}/s to clients, {stats['bytes'] / max(stats['frames'], 1):.1f} bytes/frame, "
+            f"{feed.frames / elapsed:,.0f} spectator frames/s")
+        print(f"memory:   {memory_per_game / 1024:.1f} KiB/game")
+        color = GREEN if not overruns else YELLOW
+        print(f"{color}p99 tick time uses {percentile(durations, 99) / budget:.0%} of the tick budget{RESET}")
+
+    async def players(self, games, inputs_per_second, rng):
+        """Change the paddle move of random players, like the consumers would on 'move'."""
+        period = 0.05
+        chance = inputs_per_second * period
+        while True:
+            await asleep(period)
+            for game in games:
+                for side in (LEFT, RIGHT):
+                    if rng.random() < chance:
+                        game.set_player_move(side, rng.choice([-1, 0, 1]))
+
+    async def receive(self, channel_layer, group, client):
+        channel = await channel_layer.new_channel()
+        await channel_layer.group_add(group, channel)
+        try:
+            while True:
+                message = await channel_layer.receive(channel)
+                await getattr(client, get_handler_name(message))(message)
+        except CancelledError:
+            await channel_layer.group_discard(group, channel)
+            raise
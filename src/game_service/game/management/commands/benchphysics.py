@@ -0,0 +1,128 @@
+from asyncio import run as arun
+from random import Random
+from time import perf_counter
+from django.core.management.base import BaseCommand, CommandError
+from ...Game import Game
+from ...const import LEFT, RIGHT, LEVELS, SIMULATION_HZ, GREEN, YELLOW, RESET
+
+
+class NoNetwork:
+    """Stand-in for the consumer: the physics benchmark does not send anything."""
+
+    class Layer:
+        async def group_send(self, group, message):
+            pass
+
+    def __init__(self):
+        self.channel_layer = self.Layer()
+        self.room_group_name = None
+
+
+class Command(BaseCommand):
+    help = "Compare games/second of the scalar Game physics and the NumPy batch backend"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--games", type=int, default=500)
+        parser.add_argument("--ticks", type=int, default=600)
+        parser.add_argument("--seed", type=int, default=42)
+        parser.add_argument("--check", action="store_true",
+            help="Step both backends side by side and report the largest difference")
+        parser.add_argument("--tolerance", type=float, default=1e-9)
+
+    def handle(self, *args, **options):
+        try:
+            from ...batch_physics import BatchPhysics
+        except ImportError:
+            raise CommandError("numpy is not installed")
+        self.BatchPhysics = BatchPhysics
+        if options["check"]:
+            self.check(options)
+        arun(self.bench(options))
+
+    def new_games(self, count, seed):
+        rng = Random(seed)
+        level_name = next(iter(LEVELS))
+        games = []
+        for i in range(count):
+            game = Game(i, 1, "left", 2, "right", NoNetwork(), level_name)
+            game.round_start_mult = rng.choice([1, -1])
+            game.recenter()
+            games.append(game)
+        return games
+
+    def inputs(self, seed, count, ticks):
+        """Same pseudo-random paddle moves for both backends: (tick, game, side, move)"""
+        rng = Random(seed)
+        moves = {}
+        for tick in range(0, ticks, 10):
+            for i in range(count):
+                moves.setdefault(tick, []).append((i, rng.choice([LEFT, RIGHT]), rng.choice([-1, 0, 1])))
+        return moves
+
+    async def step_scalar(self, games):
+        for game in games:
+            game.move_players()
+            await game.move_ball()
+
+    def step_batch(self, physics):
+        missed = physics.step()
+        slots = (missed >= 0).nonzero()[0]
+        if slots.size:
+            physics.new_round(slots, missed[slots])
+
+    async def bench(self, options):
+        count, ticks = options["games"], options["ticks"]
+        moves = self.inputs(options["seed"], count, ticks)
+
+        games = self.new_games(count, options["seed"])
+        start = perf_counter()
+        for tick in range(ticks):
+            for i, side, move in moves.get(tick, ()):
+                games[i].set_player_move(side, move)
+            await self.step_scalar(games)
+        scalar_time = perf_counter() - start
+
+        games = self.new_games(count, options["seed"])
+        physics = self.BatchPhysics(count)
+        slots = [physics.add(game) for game in games]
+        start = perf_counter()
+        for tick in range(ticks):
+            for i, side, move in moves.get(tick, ()):
+                physics.set_player_move(slots[i], side, move)
+            self.step_batch(physics)
+        batch_time = perf_counter() - start
+
+        scalar_rate = count * ticks / scalar_time
+        batch_rate = count * ticks / batch_time
+        print(f"{count} games x {ticks} ticks")
+        print(f"scalar: {scalar_time:.3f}s, {scalar_rate:,.0f} game-ticks/s, {scalar_rate / SIMULATION_HZ:,.0f} games/core at {SIMULATION_HZ}Hz")
+        print(f"numpy:  {batch_time:.3f}s, {batch_rate:,.0f} game-ticks/s, {batch_rate / SIMULATION_HZ:,.0f} games/core at {SIMULATION_HZ}Hz")
+        print(f"{GREEN}speedup: x{scalar_time / batch_time:.1f}{RESET}")
+
+    def check(self, options):
+        count, ticks = options["games"], options["ticks"]
+        moves = self.inputs(options["seed"], count, ticks)
+        games = self.new_games(count, options["seed"])
+        physics = self.BatchPhysics(count)
+        slots = [physics.add(game) for game in games]
+        worst = 0.0
+        for tick in range(ticks):
+            for i, side, move in moves.get(tick, ()):
+                games[i].set_player_move(side, move)
+                physics.set_player_move(slots[i], side, move)
+            arun(self.step_scalar(games))
+            self.step_batch(physics)
+            for game, slot in zip(games, slots):
+                worst = max(worst,
+                    abs(game.ball_pos[0] - physics.ball_pos[slot, 0]),
+                    abs(game.ball_pos[1] - physics.ball_pos[slot, 1]),
+                    abs(game.ball_direction[0] - physics.ball_dir[slot, 0]),
+                    abs(game.ball_direction[1] - physics.ball_dir[slot, 1]),
+                    abs(game.players[LEFT].pos - physics.pad_pos[slot, LEFT]),
+                    abs(game.players[RIGHT].pos - physics.pad_pos[slot, RIGHT]),
+                    abs(game.ball_speed - physics.ball_speed[slot]))
+        color = GREEN if worst <= options["tolerance"] else YELLOW
+        print(f"{color}check: largest difference after {ticks} ticks = {worst:.3e}{RESET}")
+        if worst > options["tolerance"]:
+            raise CommandError("NumPy backend diverges from the scalar physics")
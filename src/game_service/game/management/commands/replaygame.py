@@ -0,0 +1,54 @@
+from asyncio import run as arun
+from time import perf_counter
+from django.core.management.base import BaseCommand, CommandError
+from ...redis_pool import redis_pool
+from ...replay import InputLog, replay, replay_key, ENTRY
+from ...const import LEFT, RIGHT, GREEN, RESET
+
+
+class Command(BaseCommand):
+    help = "Export the input log of a finished game, and/or re-simulate it"
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("game_id", nargs="?", type=int,
+            help="Load the replay of this game from redis")
+        parser.add_argument("--input", help="Load the replay from this file instead of redis")
+        parser.add_argument("--export", help="Write the replay to this file")
+        parser.add_argument("--no-replay", action="store_true", help="Don't re-simulate the game")
+
+    def handle(self, *args, **options):
+        arun(self.main(options))
+
+    async def main(self, options):
+        if options["input"]:
+            with open(options["input"], "rb") as file:
+                data = file.read()
+            log = InputLog.from_bytes(data)
+        elif options["game_id"] is not None:
+            log = await self.load(options["game_id"])
+        else:
+            raise CommandError("Give a game_id or --input")
+
+        if options["export"]:
+            with open(options["export"], "wb") as file:
+                file.write(log.to_bytes())
+            print(f"Replay written to {options['export']} ({len(log.to_bytes())} bytes)")
+
+        if options["no_replay"]:
+            return
+        start = perf_counter()
+        game = await replay(log, options["game_id"] or 0)
+        elapsed = perf_counter() - start
+        left, right = game.players[LEFT], game.players[RIGHT]
+        print(f"{GREEN}{left.name} {left.score} - {right.score} {right.name}{RESET}")
+        print(f"{game.ticks} ticks, {len(log.entries) // ENTRY.size} inputs, re-simulated in {elapsed:.3f}s")
+
+    async def load(self, game_id):
+        try:
+            text = await redis_pool.client().get(replay_key(game_id))
+        finally:
+            await redis_pool.close()
+        if text is None:
+            raise CommandError(f"No replay for game {game_id}")
+        return InputLog.from_text(text)
@@ -0,0 +1,164 @@
+import json
+from signal import signal, SIGTERM, SIGINT
+from asyncio import run as arun, sleep as asleep, create_task, gather, start_server, CancelledError
+from channels.consumer import get_handler_name #type: ignore
+from channels.layers import get_channel_layer #type: ignore
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from ...Game import Game
+from ...fanout import encoded
+from ...workers import worker_channel
+from ...checkpoint import read_checkpoint
+from ...redis_pool import redis_pool
+from ...spectate import spectator_feed
+from ...metrics import registry
+from ...const import RESET, RED, GREEN, YELLOW
+
+
+class WorkerHandle:
+    """Stands in for the master PongConsumer (Game.wsh) of a game run by this worker."""
+
+    def __init__(self, worker, group):
+        self.channel_layer = worker.channel_layer
+        self.redis_client = worker.redis_client
+        self.channel_name = worker.channel # owner of the game's lease, see checkpoint.py
+        self.room_group_name = group
+
+    async def send_score(self):
+        score = self.game.get_score()
+        await self.redis_client.publish("info_mmaking", json.dumps(score))
+
+
+class Command(BaseCommand):
+    help = "Simulate the games whose game_id % GAME_WORKERS == index"
+    requires_system_checks = []
+
+    LOAD_TIMEOUT = 30 # seconds for both clients to load, before the game is dropped
+
+    def add_arguments(self, parser):
+        parser.add_argument("--index", type=int, required=True)
+        parser.add_argument("--metrics-port", type=int, default=None,
+            help="Serve the Prometheus metrics of this worker over http on that port")
+
+    def handle(self, *args, **options):
+        if not 0 <= options["index"] < settings.GAME_WORKERS:
+            raise CommandError(f"--index must be in [0, GAME_WORKERS={settings.GAME_WORKERS}[")
+        signal(SIGINT, self.signal_handler)
+        signal(SIGTERM, self.signal_handler)
+        arun(self.main(options["index"], options["metrics_port"]))
+
+    def signal_handler(self, sig, frame):
+        self.running = False
+
+    async def main(self, index, metrics_port=None):
+        self.running = True
+        self.games = {} # game_id -> (Game, task)
+        self.channel_layer = get_channel_layer()
+        self.channel = worker_channel(index)
+        self.redis_client = redis_pool.client()
+        print(f"{GREEN}Game worker {index}/{settings.GAME_WORKERS} listening on '{self.channel}'{RESET}")
+        listen_task = create_task(self.listen())
+        metrics_server = None
+        if metrics_port:
+            metrics_server = await start_server(self.serve_metrics, "0.0.0.0", metrics_port)
+        try:
+            while self.running and not listen_task.done():
+                await asleep(1)
+        finally:
+            listen_task.cancel()
+            tasks = [task for _, task in self.games.values()]
+            for task in tasks:
+                task.cancel()
+            # each game suspends itself (last checkpoint, lease released) before redis goes away
+            await gather(listen_task, *tasks, return_exceptions=True)
+            try: # and tells its spectators to wait
+                await spectator_feed.flush()
+            except Exception as e:
+                print(f"{RED}Spectator feed: {e}{RESET}")
+            if metrics_server:
+                metrics_server.close()
+            await redis_pool.close()
+
+    async def listen(self):
+        while True:
+            message = await self.channel_layer.receive(self.channel)
+            try:
+                handler = getattr(self, get_handler_name(message), None)
+                if handler is None:
+                    print(f"{RED}Unknown worker message: {message.get('type')}{RESET}")
+                    continue
+                await handler(message)
+            except Exception as e:
+                print(f"{RED}Game worker: {e}{RESET}")
+
+    # Any request gets the metrics: the worker has no other http route
+    async def serve_metrics(self, reader, writer):
+        try:
+            await reader.readuntil(b"\r\n\r\n")
+            body = registry.render().encode()
+            writer.write(b"HTTP/1.1 200 OK\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n"
+                + f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body)
+            await writer.drain()
+        except Exception as e:
+            print(f"{RED}Metrics request failed: {e}{RESET}")
+        finally:
+            writer.close()
+
+    async def game_create(self, message):
+        game_id = message["game_id"]
+        if game_id in self.games:
+            return
+        (id1, name1), (id2, name2) = message["players"]
+        wsh = WorkerHandle(self, message["group"])
+        game = Game(game_id, id1, name1, id2, name2, wsh, message["level_name"])
+        wsh.game = game
+        self.games[game_id] = (game, create_task(self.run(game)))
+
+    async def game_resume(self, message):
+        game_id = message["game_id"]
+        if game_id in self.games:
+            return
+        state = await read_checkpoint(self.redis_client, game_id)
+        if state is None:
+            print(f"{YELLOW}Game {game_id}: no checkpoint to resume from{RESET}")
+            return
+        wsh = WorkerHandle(self, message["group"])
+        game = Game.from_checkpoint(game_id, state, wsh)
+        wsh.game = game
+        self.games[game_id] = (game, create_task(self.run(game)))
+
+    async def game_loaded(self, message):
+        if message["game_id"] in self.games:
+            self.games[message["game_id"]][0].loaded = True
+
+    async def game_input(self, message):
+        if message["game_id"] in self.games:
+            self.games[message["game_id"]][0].set_player_move(
+                message["side"], message["key"], message.get("seq"), message.get("t"))
+
+    async def game_cancel(self, message):
+        if message["game_id"] in self.games:
+            print(f"{YELLOW}Game {message['game_id']} cancelled{RESET}")
+            game, task = self.games[message["game_id"]]
+            game.dropped = message.get("drop", False)
+            if message.get("notify"): # the master was kicked, its consumer can't tell the players
+                await game.group_send(encoded({"action": "game_cancelled"}))
+            task.cancel()
+
+    async def run(self, game):
+        try:
+            waited = 0
+            while not game.loaded and waited < self.LOAD_TIMEOUT:
+                await asleep(0.1)
+                waited += 0.1
+            if not game.loaded:
+                print(f"{YELLOW}Game {game.id} never loaded, dropped{RESET}")
+                return
+            await game.play()
+        except CancelledError:
+            pass
+        except Exception as e:
+            print(f"{RED}Game {game.id} crashed: {e}{RESET}")
+        finally:
+            self.games.pop(game.id, None)
+            print(f"{GREEN}Game {game.id} done, {len(self.games)} running{RESET}")
@@ -0,0 +1,157 @@
+# Metrics of this process, in the Prometheus text format.
+#
+# Scraped on /metrics (game_service/urls.py), on the service's own port: nginx
+# only proxies /game. Game workers serve them with rungameworker --metrics-port.
+#
+# Counters and histograms are updated where things happen. Values some object
+# already keeps (scheduler, spectators, redis pools) are read when scraped, by
+# collectors registered next to that object. redis_pool.py is the same file in
+# every service, so its collector is registered here.
+
+from bisect import bisect_left
+from math import inf
+from .redis_pool import redis_pool
+
+# seconds, from a fraction of a tick (8.3ms) to a few seconds of waiting
+DEFAULT_BUCKETS = (0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+
+def _labels(names, values, extra=""):
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+def _number(value):
+    if value == inf:
+        return "+Inf"
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Counter:
+
+    def __init__(self, name, help, labels=()):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.values = {} if labels else {(): 0} # label values -> count
+
+    def inc(self, *label_values, amount=1):
+        self.values[label_values] = self.values.get(label_values, 0) + amount
+
+    def samples(self):
+        for label_values, value in self.values.items():
+            yield self.name + _labels(self.labels, label_values), value
+
+
+class Histogram:
+
+    def __init__(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help
+        self.labels = labels
+        self.buckets = tuple(buckets) + (inf,)
+        self.values = {} # label values -> [counts per bucket, sum, count]
+        if not labels:
+            self.child(())
+
+    def child(self, label_values):
+        values = self.values.get(label_values)
+        if values is None:
+            values = self.values[label_values] = [[0] * len(self.buckets), 0.0, 0]
+        return values
+
+    def observe(self, value, *label_values):
+        values = self.child(label_values)
+        values[0][bisect_left(self.buckets, value)] += 1
+        values[1] += value
+        values[2] += 1
+
+    def samples(self):
+        for label_values, (counts, total, count) in self.values.items():
+            cumulative = 0
+            for bound, bucket in zip(self.buckets, counts):
+                cumulative += bucket
+                yield self.name + "_bucket" + _labels(self.labels, label_values, f'le="{_number(bound)}"'), cumulative
+            yield self.name + "_sum" + _labels(self.labels, label_values), total
+            yield self.name + "_count" + _labels(self.labels, label_values), count
+
+
+class Collected:
+    """Value(s) read when scraped. read() returns a number, or {label values: number}."""
+
+    def __init__(self, name, type, help, read, labels=()):
+        self.name = name
+        self.type = type
+        self.help = help
+        self.read = read
+        self.labels = labels
+
+    def samples(self):
+        values = self.read()
+        if not isinstance(values, dict):
+            values = {(): values}
+        for label_values, value in values.items():
+            yield self.name + _labels(self.labels, label_values), value
+
+
+class Registry:
+
+    def __init__(self):
+        self.metrics = {}
+
+    def add(self, metric, type):
+        self.metrics[metric.name] = (metric, type)
+        return metric
+
+    def counter(self, name, help, labels=()):
+        return self.add(Counter(name, help, labels), "counter")
+
+    def histogram(self, name, help, labels=(), buckets=DEFAULT_BUCKETS):
+        return self.add(Histogram(name, help, labels, buckets), "histogram")
+
+    def collect(self, name, type, help, read, labels=()):
+        return self.add(Collected(name, type, help, read, labels), type)
+
+    def render(self):
+        lines = []
+        for metric, type in self.metrics.values():
+            try:
+                samples = list(metric.samples())
+            except Exception as e:
+                lines.append(f"# {metric.name} unavailable: {e}")
+                continue
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {type}")
+            lines.extend(f"{name} {_number(value)}" for name, value in samples)
+        return "\n".join(lines) + "\n"
+
+
+# One per process
+registry = Registry()
+
+# Updated by the consumers and the games
+inputs = registry.counter("pong_inputs_total", "Paddle inputs applied to the games")
+inputs_dropped = registry.counter("pong_inputs_dropped_total", "Paddle inputs dropped because their channel was full")
+flood_mutes = registry.counter("pong_flood_mutes_total", "Players muted by the anti-flood")
+frames_sent = registry.counter("pong_frames_sent_total", "Game frames broadcast, by audience", ("audience",))
+frames_dropped = registry.counter("pong_frames_dropped_total",
+    "Frames not delivered: failed socket writes, spectator frames replaced before being published", ("audience",))
+connect_phase = registry.histogram("pong_connect_phase_seconds",
+    "Time from the websocket connection to the game start, by phase", ("phase",))
+group_send_duration = registry.histogram("pong_group_send_duration_seconds",
+    "Time to broadcast a message to a game group, local fast path or channel layer", ("path",))
+input_lag = registry.histogram("pong_input_lag_seconds",
+    "Game time between the frame a client was at and its input being applied (about a round trip)")
+
+# redis_pool.stats() key, metric, type, help
+for stat, name, type, help in (
+    ("created", "connections_created_total", "counter", "Connections opened by the pool"),
+    ("in_use", "connections_in_use", "gauge", "Connections currently borrowed from the pool"),
+    ("acquired", "connections_acquired_total", "counter", "Connections borrowed from the pool"),
+    ("failures", "failures_total", "counter", "Connections not obtained within POOL_TIMEOUT, or not connected"),
+    ("max_wait", "max_wait_seconds", "gauge", "Longest wait for a connection"),
+):
+    registry.collect(f"pong_redis_pool_{name}", type, help,
+        lambda stat=stat: {(pool,): stats[stat] for pool, stats in redis_pool.stats().items()}, ("pool",))
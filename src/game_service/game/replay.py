@@ -0,0 +1,126 @@
+# Input logs: everything needed to re-simulate a match, a few KB per game.
+#
+# The simulation is deterministic once the initial round_start_mult and the level
+# are known, so a match is stored as its header plus the paddle inputs, each
+# tagged with the number of ticks the game had completed when it was received.
+#
+# Layout (little endian):
+#   header  REPLAY_MAGIC, u8 version, u16 SIMULATION_HZ, i8 round_start_mult,
+#           then level name, player 0, player 1 (u32 id + name), names as u8 length + utf-8
+#   entries u32 tick, u8 side, i8 move     (appended as the game goes)
+
+from base64 import b64encode, b64decode
+from struct import Struct
+from .const import SIMULATION_HZ, LEFT, RIGHT
+
+REPLAY_MAGIC = b"PRPL"
+REPLAY_VERSION = 1
+REPLAY_TTL = 7 * 24 * 3600 # seconds kept in redis
+
+HEADER = Struct("<4sBHb")
+PLAYER = Struct("<I")
+ENTRY = Struct("<IBb")
+
+
+def replay_key(game_id):
+    return f"replay_{game_id}"
+
+
+def _pack_str(text):
+    data = text.encode("utf-8")[:255]
+    return bytes([len(data)]) + data
+
+
+def _unpack_str(data, offset):
+    length = data[offset]
+    return data[offset + 1:offset + 1 + length].decode("utf-8"), offset + 1 + length
+
+
+class InputLog:
+
+    def __init__(self, level_name, round_start_mult, players):
+        """players: [(id, name), (id, name)], left first"""
+        self.level_name = level_name
+        self.round_start_mult = round_start_mult
+        self.players = players
+        self.entries = bytearray()
+        self.last_moves = [0, 0]
+
+    def record(self, tick, side, move):
+        if self.last_moves[side] == move:
+            return
+        self.last_moves[side] = move
+        self.entries += ENTRY.pack(tick, side, move)
+
+    def inputs(self):
+        """(tick, side, move) in recorded order"""
+        return ENTRY.iter_unpack(self.entries)
+
+    def to_bytes(self):
+        data = bytearray(HEADER.pack(REPLAY_MAGIC, REPLAY_VERSION, SIMULATION_HZ, self.round_start_mult))
+        data += _pack_str(self.level_name)
+        for player_id, name in self.players:
+            data += PLAYER.pack(int(player_id)) + _pack_str(name)
+        return bytes(data + self.entries)
+
+    @classmethod
+    def from_bytes(cls, data):
+        magic, version, hz, round_start_mult = HEADER.unpack_from(data, 0)
+        if magic != REPLAY_MAGIC or version != REPLAY_VERSION:
+            raise ValueError("Not a replay, or unsupported version")
+        if hz != SIMULATION_HZ:
+            raise ValueError(f"Replay was recorded at {hz}Hz, this server simulates at {SIMULATION_HZ}Hz")
+        level_name, offset = _unpack_str(data, HEADER.size)
+        players = []
+        for _ in (LEFT, RIGHT):
+            player_id, = PLAYER.unpack_from(data, offset)
+            name, offset = _unpack_str(data, offset + PLAYER.size)
+            players.append((player_id, name))
+        log = cls(level_name, round_start_mult, players)
+        entries = data[offset:]
+        log.entries = bytearray(entries[:len(entries) - len(entries) % ENTRY.size])
+        return log
+
+    def to_text(self):
+        return b64encode(self.to_bytes()).decode("ascii")
+
+    @classmethod
+    def from_text(cls, text):
+        return cls.from_bytes(b64decode(text))
+
+
+class ReplayHandle:
+    """Stands in for the consumer while re-simulating. Messages the game would broadcast
+    are given to on_message (for example to stream them to spectators), or dropped."""
+
+    class Layer:
+        def __init__(self, on_message):
+            self.on_message = on_message
+
+        async def group_send(self, group, message):
+            if self.on_message:
+                await self.on_message(message)
+
+    def __init__(self, on_message=None):
+        self.channel_layer = self.Layer(on_message)
+        self.room_group_name = None
+
+
+async def replay(log, game_id=0, on_message=None, max_ticks=SIMULATION_HZ * 3600):
+    """Re-simulate a whole match from its input log. Returns the finished Game."""
+    from .Game import Game
+    (left_id, left_name), (right_id, right_name) = log.players
+    game = Game(game_id, left_id, left_name, right_id, right_name, ReplayHandle(on_message), log.level_name)
+    game.replay = None # don't record the replay of a replay
+    game.round_start_mult = log.round_start_mult
+    game.recenter()
+    game.loaded = True
+    inputs = list(log.inputs())
+    next_input = 0
+    while not game.finished and game.ticks < max_ticks:
+        while next_input < len(inputs) and inputs[next_input][0] <= game.ticks:
+            _, side, move = inputs[next_input]
+            game.set_player_move(side, move)
+            next_input += 1
+        await game.tick()
+    return game
@@ -1,8 +1,10 @@
 from django.urls import re_path
 from .PongConsumers import PongConsumer
+from .SpectatorConsumer import SpectatorConsumer
 from .NoConsumer import NoConsumer
 
 websocket_urlpatterns = [
     re_path(r"game/(?P<game_id>[0-9]+)/$", PongConsumer.as_asgi()),
+    re_path(r"game/(?P<game_id>[0-9]+)/watch/$", SpectatorConsumer.as_asgi()),
     re_path(r"^.*$", NoConsumer.as_asgi()),
 ]
\ No newline at end of file
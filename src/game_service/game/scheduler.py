@@ -0,0 +1,106 @@
+from collections import deque
+from asyncio import get_running_loop, gather, create_task, sleep as asleep, CancelledError
+from time import monotonic
+from .const import DELTATIME, SIMULATION_HZ, YELLOW, RESET
+from .metrics import registry
+
+
+class GameLoopScheduler:
+    """Drives every Game of this process from a single fixed-timestep clock.
+
+    Games are registered by Game.play() and ticked together, DELTATIME apart.
+    If the loop falls behind, missed ticks are replayed (up to MAX_CATCH_UP per wakeup)
+    so that the simulation keeps the same pace; beyond that, ticks are dropped."""
+
+    MAX_CATCH_UP = 5 # ticks replayed in a row before giving up on the late ones
+    RECENT_TICKS = 10 * SIMULATION_HZ # tick durations kept for percentiles
+
+    def __init__(self, deltatime=DELTATIME):
+        self.deltatime = deltatime
+        self.games = {} # Game -> future resolved when the game is finished
+        self.task = None
+        # stats
+        self.ticks = 0
+        self.overruns = 0
+        self.dropped_ticks = 0
+        self.last_tick_duration = 0.0
+        self.max_tick_duration = 0.0
+        self.recent_durations = deque(maxlen=self.RECENT_TICKS)
+
+    async def run(self, game):
+        """Register game and wait until it is finished (or the caller is cancelled)."""
+        future = get_running_loop().create_future()
+        self.games[game] = future
+        if self.task is None or self.task.done():
+            self.task = create_task(self.loop())
+        try:
+            await future
+        finally:
+            self.games.pop(game, None)
+
+    async def loop(self):
+        next_tick = monotonic()
+        while self.games:
+            now = monotonic()
+            if now < next_tick:
+                await asleep(next_tick - now)
+                now = monotonic()
+            late_ticks = int((now - next_tick) / self.deltatime) + 1
+            steps = min(late_ticks, self.MAX_CATCH_UP)
+            if late_ticks > steps:
+                self.dropped_ticks += late_ticks - steps
+                print(f"{YELLOW}Game loop is late, dropped {late_ticks - steps} ticks ({len(self.games)} games).{RESET}")
+                next_tick = now - (steps - 1) * self.deltatime
+            for _ in range(steps):
+                await self.step()
+            next_tick += steps * self.deltatime
+        self.task = None
+
+    async def step(self):
+        start = monotonic()
+        games = list(self.games.items())
+        await gather(*(self.tick_game(game, future) for game, future in games))
+        duration = monotonic() - start
+        self.ticks += 1
+        self.last_tick_duration = duration
+        self.max_tick_duration = max(self.max_tick_duration, duration)
+        self.recent_durations.append(duration)
+        tick_duration.observe(duration)
+        if duration > self.deltatime:
+            self.overruns += 1
+
+    async def tick_game(self, game, future):
+        if future.done():
+            return
+        try:
+            await game.tick()
+        except CancelledError:
+            raise
+        except Exception as e:
+            self.games.pop(game, None)
+            future.set_exception(e)
+            return
+        if game.finished:
+            self.games.pop(game, None)
+            future.set_result(None)
+
+    def stats(self):
+        return {
+            "games": len(self.games),
+            "ticks": self.ticks,
+            "overruns": self.overruns,
+            "dropped_ticks": self.dropped_ticks,
+            "last_tick_duration": self.last_tick_duration,
+            "max_tick_duration": self.max_tick_duration,
+        }
+
+
+# One scheduler per game_service process
+scheduler = GameLoopScheduler()
+
+tick_duration = registry.histogram("pong_tick_duration_seconds", "Time to tick every game of the process once")
+registry.collect("pong_games_active", "gauge", "Games ticked by this process", lambda: len(scheduler.games))
+registry.collect("pong_ticks_total", "counter", "Ticks of the game loop", lambda: scheduler.ticks)
+registry.collect("pong_tick_overruns_total", "counter", "Ticks longer than DELTATIME", lambda: scheduler.overruns)
+registry.collect("pong_dropped_ticks_total", "counter", "Late ticks skipped instead of being caught up",
+    lambda: scheduler.dropped_ticks)
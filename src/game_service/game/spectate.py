@@ -0,0 +1,196 @@
+# Spectators: one shared, rate-limited stream per game.
+#
+# The process running a game (SpectatorFeed) hands a keyframe to the feed every
+# SPECTATOR_INTERVAL ticks. The feed publishes the latest frame of each game on
+# the redis channel spectate_<game_id>, from its own task: the game loop never
+# waits on redis, and its cost does not depend on the number of spectators.
+#
+# Every process with spectators (SpectatorHub) subscribes once per watched game,
+# keeps the latest frame, and writes it to its local spectator sockets directly,
+# without going through the channel layer.
+#
+# Text messages on the same channel ("init", "wait", "game_won", "game_cancelled") are
+# JSON and start with '{', frames start with FRAME_VERSION.
+
+import json
+from asyncio import create_task, gather, sleep as asleep, CancelledError
+from .redis_pool import redis_pool
+from .metrics import registry, frames_sent, frames_dropped
+from .const import SPECTATOR_HZ, RED, RESET
+
+SPECTATE_INFO_TTL = 3 * 3600 # seconds
+LAST_ACTIONS = ("game_won", "game_cancelled") # the spectators are disconnected after these
+
+
+def spectate_channel(game_id):
+    return f"spectate_{game_id}"
+
+
+def spectate_info_key(game_id):
+    return f"spectate_{game_id}_info"
+
+
+class SpectatorFeed:
+    """Publishing side, in the process that runs the games."""
+
+    def __init__(self):
+        self.frames = {} # game_id -> latest frame not published yet
+        self.messages = [] # (game_id, json text, is_info), published in order before the frames.
+                           # is_info None: the info of the game is kept as is
+        self.redis_client = None
+        self.task = None
+        self.published = 0
+
+    def start(self):
+        if self.task is None or self.task.done():
+            self.task = create_task(self.run())
+
+    def open(self, game):
+        """The game starts: tell the spectators who plays where."""
+        info = json.dumps({
+            "action": "init",
+            "side": 2, # neutral
+            "lplayer": game.players[0].name,
+            "rplayer": game.players[1].name,
+            "level_name": game.level_name,
+        })
+        self.messages.append((game.id, info, True))
+        self.start()
+
+    def publish(self, game_id, frame):
+        if game_id in self.frames:
+            frames_dropped.inc("spectators")
+        self.frames[game_id] = frame # older frames of the same game are not worth sending
+
+    def pause(self, game_id, message):
+        """The game is suspended, it may be resumed (by any process): the spectators stay."""
+        self.frames.pop(game_id, None)
+        self.messages.append((game_id, json.dumps(message), None))
+        self.start()
+
+    def close(self, game_id, message):
+        self.frames.pop(game_id, None)
+        self.messages.append((game_id, json.dumps(message), False))
+        self.start()
+
+    async def run(self):
+        while True:
+            try:
+                await asleep(1 / SPECTATOR_HZ)
+                await self.flush()
+            except CancelledError:
+                raise
+            except Exception as e:
+                print(f"{RED}Spectator feed: {e}{RESET}")
+                await asleep(1)
+
+    async def flush(self):
+        if not self.frames and not self.messages:
+            return
+        frames, self.frames = self.frames, {}
+        messages, self.messages = self.messages, []
+        if self.redis_client is None:
+            self.redis_client = redis_pool.client(decode_responses=False) # frames are bytes
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            for game_id, text, is_info in messages:
+                if is_info:
+                    pipe.set(spectate_info_key(game_id), text, ex=SPECTATE_INFO_TTL)
+                elif is_info is False:
+                    pipe.delete(spectate_info_key(game_id))
+                pipe.publish(spectate_channel(game_id), text)
+            for game_id, frame in frames.items():
+                pipe.publish(spectate_channel(game_id), frame)
+            await pipe.execute()
+        self.published += len(frames)
+        frames_sent.inc("spectators", amount=len(frames))
+
+
+class SpectatorHub:
+    """Receiving side: local spectator consumers, by game id."""
+
+    def __init__(self):
+        self.watchers = {} # game_id -> set of consumers
+        self.latest = {} # game_id -> latest frame
+        self.redis_client = None
+        self.pubsub = None
+        self.task = None
+        self.sent = 0
+
+    async def add(self, game_id, consumer):
+        if self.pubsub is None:
+            self.redis_client = redis_pool.client(decode_responses=False) # frames are bytes
+            self.pubsub = redis_pool.pubsub(decode_responses=False, ignore_subscribe_messages=True)
+        watchers = self.watchers.setdefault(game_id, set())
+        watchers.add(consumer)
+        if len(watchers) == 1:
+            await self.pubsub.subscribe(spectate_channel(game_id))
+        if self.task is None or self.task.done():
+            self.task = create_task(self.listen())
+
+        # catch up: who plays, and where the ball is right now
+        info = await self.redis_client.get(spectate_info_key(game_id))
+        if info:
+            await consumer.send_spectated(text_data=info.decode("utf-8"))
+        if game_id in self.latest:
+            await consumer.send_spectated(bytes_data=self.latest[game_id])
+
+    async def discard(self, game_id, consumer):
+        watchers = self.watchers.get(game_id)
+        if watchers is None:
+            return
+        watchers.discard(consumer)
+        if watchers:
+            return
+        del self.watchers[game_id]
+        self.latest.pop(game_id, None)
+        try:
+            await self.pubsub.unsubscribe(spectate_channel(game_id))
+        except Exception as e:
+            print(f"{RED}Spectator hub: {e}{RESET}")
+
+    async def listen(self):
+        while self.watchers:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except CancelledError:
+                raise
+            except Exception as e:
+                print(f"{RED}Spectator hub: {e}{RESET}")
+                await asleep(1)
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            game_id = message["channel"].decode("utf-8").removeprefix("spectate_")
+            await self.dispatch(game_id, message["data"])
+
+    async def dispatch(self, game_id, data):
+        watchers = self.watchers.get(game_id)
+        if not watchers:
+            return
+        if data[:1] == b"{":
+            text = data.decode("utf-8")
+            kwargs = {"text_data": text, "last": json.loads(text).get("action") in LAST_ACTIONS}
+        else:
+            self.latest[game_id] = data
+            kwargs = {"bytes_data": data}
+        await gather(*(consumer.send_spectated(**kwargs) for consumer in list(watchers)))
+        self.sent += len(watchers)
+
+    def stats(self):
+        return {
+            "watched_games": len(self.watchers),
+            "spectators": sum(len(watchers) for watchers in self.watchers.values()),
+            "frames_sent": self.sent,
+        }
+
+
+# One of each per game_service process
+spectator_feed = SpectatorFeed()
+spectator_hub = SpectatorHub()
+
+registry.collect("pong_spectated_games", "gauge", "Games watched by spectators of this process",
+    lambda: len(spectator_hub.watchers))
+registry.collect("pong_spectators", "gauge", "Spectator sockets of this process",
+    lambda: sum(len(watchers) for watchers in spectator_hub.watchers.values()))
+registry.collect("pong_spectator_messages_sent_total", "counter", "Frames and messages written to spectator sockets",
+    lambda: spectator_hub.sent)
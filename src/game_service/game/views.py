@@ -0,0 +1,6 @@
+from django.http import HttpResponse
+from .metrics import registry
+
+
+def metrics(request):
+    return HttpResponse(registry.render(), content_type="text/plain; version=0.0.4; charset=utf-8")
@@ -0,0 +1,25 @@
+# Game workers: `manage.py rungameworker --index N` processes owning the simulations.
+#
+# Games are sharded by game_id over settings.GAME_WORKERS workers. The master
+# PongConsumer sends the messages below to the worker channel of its game, the
+# worker runs the Game and broadcasts frames to the game group as usual.
+#
+#   game.create  game_id, group, level_name, players [[id, name], [id, name]]
+#   game.resume  game_id, group               rebuild the game from its checkpoint
+#   game.loaded  game_id                      both clients are ready
+#   game.input   game_id, side, key, seq, t
+#   game.cancel  game_id, drop, notify        a player left. drop: not resumable, notify: tell the players (kick)
+
+from django.conf import settings
+
+
+def simulation_is_remote():
+    return settings.GAME_WORKERS > 0
+
+
+def worker_channel(game_id):
+    return f"game_worker_{int(game_id) % settings.GAME_WORKERS}"
+
+
+async def send_to_worker(channel_layer, game_id, message):
+    await channel_layer.send(worker_channel(game_id), dict(message, game_id=str(game_id)))
@@ -19,6 +19,7 @@ ALLOWED_HOSTS = [
     '.42mulhouse.fr',
     'localhost',
     '127.0.0.1',
+    'pong', # metrics, scraped from the docker network
 ]
 
 # settings.py
@@ -71,11 +72,30 @@ ASGI_APPLICATION = 'game_service.asgi.application'
 
 REDIS_PASSWORD = os.getenv("REDIS_PASSWORD")
 
+# Game tickets are minted by matchmaking with the backend key, see PongConsumer.check_ticket
+BACKEND_JWT = {
+    "PUBLIC_KEY": os.getenv("BACKEND_JWT_PUBLIC_KEY"),
+    "ALGORITHM": "RS256",
+}
+
+# Number of `manage.py rungameworker` processes simulating the games, sharded by game_id.
+# 0: games are simulated by the master PongConsumer, in the uvicorn process.
+# docker-compose runs 2 (pong-worker-0 and pong-worker-1).
+GAME_WORKERS = int(os.getenv("GAME_WORKERS", "0"))
+
 CHANNEL_LAYERS = {
     "default": {
         "BACKEND": "channels_redis.core.RedisChannelLayer",
         "CONFIG": {
             "hosts": [{"host": "redis", "port": 6379, "password": REDIS_PASSWORD}],
+            # Messages waiting in a channel before send() raises ChannelFull.
+            # game_worker_*: the inputs and commands of every game of a shard.
+            # specific.*: the inbox of a whole uvicorn process, shared by all its consumers
+            # (inputs for the masters, group messages, frames of remote games).
+            "channel_capacity": {
+                "game_worker_*": 2000,
+                "specific.*": 5000,
+            },
         },
     },
 }
@@ -0,0 +1,6 @@
+from django.urls import path
+from game import views
+
+urlpatterns = [
+    path('metrics', views.metrics),
+]
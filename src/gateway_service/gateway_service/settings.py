@@ -32,6 +32,17 @@ ALLOWED_HOSTS = [
     '127.0.0.1',
 ]
 
+# Only used by the loadgen command, to sign the tokens of synthetic clients
+FRONTEND_JWT = {
+    "PRIVATE_KEY": os.getenv("JWT_PRIVATE_KEY"),
+    "ALGORITHM": "RS256",
+}
+
+BACKEND_JWT = {
+    "PRIVATE_KEY": os.getenv("BACKEND_JWT_PRIVATE_KEY"),
+    "ALGORITHM": "RS256",
+}
+
 # Application definition
 
 INSTALLED_APPS = [
@@ -1,9 +1,11 @@
-from json import dumps, loads
+from json import dumps
 from channels.generic.websocket import AsyncJsonWebsocketConsumer # type: ignore
-from redis.asyncio import from_url
+from .redis_pool import redis_pool
+from .listener import channel_listener
+from .streams import add_to_stream
+from .presence import claim_presence, release_presence, new_session
 from asyncio import create_task, sleep as asleep
 from datetime import datetime, timezone
-import requests
 import time
 from collections import deque
 from django.conf import settings
@@ -14,18 +16,31 @@ class GatewayConsumer(AsyncJsonWebsocketConsumer):
     MESSAGE_LIMIT = 10 # per second
     TIME_WINDOW = 1 # seconds
     MAX_MESSAGE_SIZE = 50
+    # Outgoing messages within BATCH_WINDOW are sent as one {"batch": [...]} frame
+    BATCH_WINDOW = 0.005 # seconds
+    BATCH_MAX_BYTES = 16384
     REDIS_GROUPS = {
         'chat': 'deep_chat',
         'mmaking': 'deep_mmaking',
         'social': 'deep_social',
         'auth': 'auth_social',
     }
+    # Work for the chat and social workers, see streams.py. Their answers come on REDIS_GROUPS.
+    REDIS_STREAMS = {
+        'chat': 'deep_chat_stream',
+        'social': 'deep_social_stream',
+    }
 
     async def connect(self):
         self.message_timestamps = deque(maxlen=self.MESSAGE_LIMIT) # collecting message's timestamp
         self.connected = False
         self.consumer_id = None
         self.consumer_name = None
+        self.outbox = [] # encoded messages waiting for the end of the batch window
+        self.outbox_size = 0
+        self.flush_task = None
+        self.flush_now = False # flush_task doesn't wait for the end of the batch window
+        self.presence_session = None
 
         if not self.scope["payload"]:
             await self.kick(message="Unauthentified")
@@ -47,22 +62,30 @@ class GatewayConsumer(AsyncJsonWebsocketConsumer):
             self.connected = True
         except Exception as e:
             print(e)
+            await self.release_presence() # disconnect() has nothing to clean up
+            return
         print(f"User {self.consumer_id} is authenticated as {self.consumer_name}")
+        try:
+            await channel_listener.add(self, self.REDIS_GROUPS.values())
+        except Exception as e:
+            print(f"Subscription error : {e}")
         await self.send_online_status('online')
 
     async def already_connected(self):
-        status = await self.get_own_status()
-        return status != "offline"
+        """Claims the presence of the user (presence.py), True if another socket holds it"""
+        session = new_session(channel_listener.front_channel)
+        try:
+            if not await claim_presence(self.redis_client, self.consumer_id, session):
+                return True
+        except Exception as e:
+            print(f"Presence error : {e}")
+            return False
+        self.presence_session = session
+        return False
 
     async def connect_to_redis(self):
         try:
-            REDIS_PASSWORD = settings.REDIS_PASSWORD
-
-            self.redis_client = await from_url(f"redis://:{REDIS_PASSWORD}@redis:6379", decode_responses=True)
-            
-            self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
-            await self.pubsub.subscribe(*self.REDIS_GROUPS.values())  # Subscribe all channels
-            self.listen_task = create_task(self.listen_to_channels())
+            self.redis_client = redis_pool.client() # shared by the whole process, never closed here
         except Exception as e:
             print(e)
             raise Exception
@@ -79,13 +102,14 @@ class GatewayConsumer(AsyncJsonWebsocketConsumer):
 
     async def disconnect(self, close_code):
         if not self.connected:
+            await self.release_presence() # in case it was claimed
             return
+        await channel_listener.discard(self)
+        if self.flush_task:
+            self.flush_task.cancel()
+        await self.release_presence()
         await self.send_online_status('offline')
         await self.send_mmaking_disconnection()
-        await self.pubsub.unsubscribe() # unsubscribe all channels
-        await self.pubsub.close()
-        await self.redis_client.close()
-        self.listen_task.cancel()
 
     def get_user_infos(self):
         data = self.scope["payload"]
@@ -95,24 +119,6 @@ class GatewayConsumer(AsyncJsonWebsocketConsumer):
         else:
             return None
 
-    def get_public_key(self):
-        try:
-            url = "https://nginx:8443/api/v1/auth/public-key/"
-
-            response = requests.get(
-                url,
-                timeout=10,
-                cert=("/etc/ssl/gateway.crt", "/etc/ssl/gateway.key"),
-                verify="/etc/ssl/ca.crt"
-            )
-
-            if response.status_code == 200:
-                self.public_key = response.json().get("public_key") # Ou response.json() si c'est un JSON
-            else:
-                raise RuntimeError("Impossible de récupérer la clé publique JWT")
-        except RuntimeError as e:
-            raise(e)
-        
     async def receive_json(self, data):
         """Data incoming from client ws => publish to concerned redis group.\n
         Possible 'service' values are 'mmaking', 'chat', 'social'"""
@@ -126,7 +132,7 @@ class GatewayConsumer(AsyncJsonWebsocketConsumer):
             data['header']['id'] = self.consumer_id
             # data['header']['token'] = self.token
             data['body']['timestamp'] = datetime.now(timezone.utc).isoformat()
-            await self.forward_with_redis(data, group)
+            await self.forward_with_redis(data, data['header']['service'])
             return
         await self.kick()
 
@@ -157,63 +163,59 @@ class GatewayConsumer(AsyncJsonWebsocketConsumer):
             return False
         return True
 
-    def check_front_data(self, message):
-        try:
-            data = message.get('data')
-            if not data:
-                return None
-            data = loads(data)
-            if not isinstance(data, dict) or "header" not in data:
-                return None
-            header = data.get('header')
-            if not isinstance(header, dict) or header.get('dest') != 'front':
-                return None
-        except:
-            return None
-        return data
+    def send_batched(self, text):
+        """Send an encoded message with the others of the same batch window.\n
+        The socket is only written by the flush task of this consumer: the caller (the
+        listener of the whole process) never waits on it. A full outbox is flushed at once."""
+        self.outbox.append(text)
+        self.outbox_size += len(text)
+        full = self.outbox_size >= self.BATCH_MAX_BYTES
+        if self.flush_task is None or (full and not self.flush_now):
+            if self.flush_task: # still waiting for the end of the window
+                self.flush_task.cancel()
+            self.flush_now = full
+            self.flush_task = create_task(self.flush_later(0 if full else self.BATCH_WINDOW))
 
-    async def listen_to_channels(self):
-        """Listen redis to send data back to appropriate client
-        possible 'service' values are 'mmaking', 'chat', 'social' """
-        async for message in self.pubsub.listen():
-            data = self.check_front_data(message)
-            if not data:
-                continue
-            if self.right_consumer(data['header']['id']):
-                try:
-                    del data['header']['dest']
-                    if data['header'].get('token'):
-                        del data['header']['token']
-                    await self.send_json(data)
-                except Exception as e:
-                    print(f"Send error : {e}")
+    async def flush_later(self, delay):
+        await asleep(delay)
+        self.flush_task = None
+        await self.flush_outbox()
 
-    def right_consumer(self, id):
-        """check if actual consumer is the recipient we're looking for"""
-        return (str(id) == self.consumer_name or int(id) == self.consumer_id)
+    async def flush_outbox(self):
+        if not self.outbox:
+            return
+        texts, self.outbox, self.outbox_size = self.outbox, [], 0
+        batches, size = [[]], 0 # frames of BATCH_MAX_BYTES at most, unless a message is larger
+        for text in texts:
+            if batches[-1] and size + len(text) > self.BATCH_MAX_BYTES:
+                batches.append([])
+                size = 0
+            batches[-1].append(text)
+            size += len(text)
+        try:
+            for batch in batches:
+                await self.send(text_data=batch[0] if len(batch) == 1 else '{"batch": [' + ", ".join(batch) + ']}')
+        except Exception as e:
+            print(f"Send error : {e}")
 
-    async def forward_with_redis(self, data, group):
+    async def forward_with_redis(self, data, service):
             try:
-                await self.redis_client.publish(group, dumps(data))
+                stream = self.REDIS_STREAMS.get(service)
+                if stream:
+                    await add_to_stream(self.redis_client, stream, data)
+                else:
+                    await self.redis_client.publish(self.REDIS_GROUPS[service], dumps(data))
             except Exception as e:
                 print(f"Publish error : {e}")
 
-    async def get_own_status(self):
-        test = 5
-        data = {'user_id': self.consumer_id}
-        status = None
-        await self.redis_client.publish(self.REDIS_GROUPS['auth'], dumps(data))
-        while status is None and test >= 0:
-            try:
-                status = await self.redis_client.get(f'is_{self.consumer_id}_logged')
-                if status is not None:
-                    return status
-            except Exception as e:
-                print(f"Error occurred: {str(e)}")
-                return "offline"
-            await asleep(0.1)
-            test -= 1
-        return "offline"
+    async def release_presence(self):
+        if self.presence_session is None:
+            return
+        try:
+            await release_presence(self.redis_client, self.consumer_id, self.presence_session)
+        except Exception as e:
+            print(f"Presence error : {e}")
+        self.presence_session = None
 
     async def get_friends_status(self):
         """get friends status AND publish my own status"""
@@ -227,7 +229,7 @@ class GatewayConsumer(AsyncJsonWebsocketConsumer):
                 "status": "info"
             }
         }
-        await self.redis_client.publish(self.REDIS_GROUPS.get("social"), dumps(data))
+        await add_to_stream(self.redis_client, self.REDIS_STREAMS["social"], data)
 
     async def send_online_status(self, status):
         """Send all friends our status"""
@@ -241,7 +243,7 @@ class GatewayConsumer(AsyncJsonWebsocketConsumer):
                 "status": status
             }
         }
-        await self.redis_client.publish(self.REDIS_GROUPS.get("social"), dumps(data))
+        await add_to_stream(self.redis_client, self.REDIS_STREAMS["social"], data)
 
     async def send_mmaking_disconnection(self):
         """Send mmaking disco info"""
@@ -0,0 +1,74 @@
+# JWT public keys of the auth service, fetched once and cached for the whole process.
+#
+# The websocket handshake only waits for the auth service the very first time.
+# After that the cached key is used, and it is refreshed in the background when
+# it gets older than TTL - REFRESH_BEFORE. If the auth service is down, the last
+# known keys keep being used.
+#
+# /auth/public-key/ answers {"public_key": pem}, used for tokens without "kid",
+# and may also answer {"keys": {kid: pem, ...}} to rotate keys.
+
+from asyncio import create_task, shield, to_thread
+from time import monotonic
+import requests
+from cryptography.hazmat.primitives.serialization import load_pem_public_key
+
+CERT = ("/etc/ssl/gateway.crt", "/etc/ssl/gateway.key")
+
+
+class PublicKeyProvider:
+    URL = "https://nginx:8443/api/v1/auth/public-key/"
+    TTL = 3600 # seconds
+    REFRESH_BEFORE = 300 # seconds before TTL, refresh in the background
+    RETRY_INTERVAL = 10 # seconds between two fetches, when one failed or a kid is unknown
+
+    def __init__(self, cert):
+        self.cert = cert
+        self.keys = {} # kid -> parsed key, None for the default key
+        self.fetched_at = None
+        self.last_attempt = None
+        self.task = None
+
+    async def get_key(self, kid=None):
+        if not self.keys:
+            await self.refresh()
+        elif monotonic() - self.fetched_at > self.TTL - self.REFRESH_BEFORE and self.may_retry():
+            self.start_refresh()
+        if kid is not None and kid not in self.keys and self.may_retry():
+            await self.refresh() # the key was probably rotated
+        return self.keys.get(kid, self.keys.get(None))
+
+    def may_retry(self):
+        return self.last_attempt is None or monotonic() - self.last_attempt > self.RETRY_INTERVAL
+
+    def start_refresh(self):
+        if self.task is None or self.task.done():
+            self.task = create_task(self.fetch())
+        return self.task
+
+    async def refresh(self):
+        # every handshake waiting for the keys shares the same request
+        await shield(self.start_refresh())
+
+    async def fetch(self):
+        self.last_attempt = monotonic()
+        try:
+            response = await to_thread(requests.get, self.URL, timeout=10, cert=self.cert, verify="/etc/ssl/ca.crt")
+            if response.status_code != 200:
+                raise RuntimeError(f"auth answered {response.status_code}")
+            data = response.json()
+            keys = {}
+            if data.get("public_key"):
+                keys[None] = load_pem_public_key(data["public_key"].encode())
+            for kid, pem in data.get("keys", {}).items():
+                keys[kid] = load_pem_public_key(pem.encode())
+            if not keys:
+                raise RuntimeError("no key in the answer")
+            self.keys = keys
+            self.fetched_at = monotonic()
+        except Exception as e:
+            print(f"Impossible de récupérer la clé publique JWT: {e}")
+
+
+# One per process
+key_provider = PublicKeyProvider(CERT)
@@ -0,0 +1,196 @@
+# One redis subscriber per gateway process.
+#
+# The services answer the fronts on the REDIS_GROUPS channels, with the
+# recipient in header.id (user id, or username). Instead of one subscription per
+# websocket, each parsing every message to keep the few addressed to its user,
+# the process subscribes once: each message is parsed once, and written to the
+# local consumers of its recipient only, found by id or name.
+#
+# With several gateway replicas, each process also has its own channel,
+# front_<host>_<pid>, and keeps front_route_id_<user id> and
+# front_route_name_<username> pointing to it while the user is connected here. The workers publish on that
+# channel (publish_front(), front_route.py in each service), so that a message
+# only reaches the replica of its recipient. The broadcast channels remain for
+# users without a route.
+
+import os
+import socket
+from json import dumps, loads
+from asyncio import create_task, sleep as asleep, CancelledError, Lock
+from .redis_pool import redis_pool
+from .presence import refresh_presence, PRESENCE_REFRESH
+
+ROUTE_TTL = 60 # seconds, the routes of a crashed replica expire after that
+
+# Deletes the routes still pointing to this replica: the user may have reconnected elsewhere
+DELETE_ROUTES = """
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[1] then
+        redis.call('DEL', key)
+    end
+end
+"""
+
+
+# Ids and usernames have their own keys: a username can look like the id of someone else
+def id_route_key(user_id):
+    return f"front_route_id_{user_id}"
+
+
+def name_route_key(username):
+    return f"front_route_name_{username}"
+
+
+def check_front_data(raw):
+    """The message as a dict if it is addressed to a front, else None"""
+    try:
+        data = loads(raw)
+    except (TypeError, ValueError):
+        return None
+    if not isinstance(data, dict):
+        return None
+    header = data.get('header')
+    if not isinstance(header, dict) or header.get('dest') != 'front' or 'id' not in header:
+        return None
+    return data
+
+
+class ChannelListener:
+    """Local GatewayConsumers by user id and by username, fed by one pub/sub."""
+
+    def __init__(self):
+        self.by_id = {} # consumer_id -> set of consumers
+        self.by_name = {} # consumer_name -> set of consumers
+        self.channels = ()
+        self.front_channel = f"front_{socket.gethostname()}_{os.getpid()}"
+        self.pubsub = None
+        self.redis_client = None
+        self.delete_routes = None
+        self.task = None
+        self.sessions_task = None
+        self.lock = Lock() # the first consumers of the process connect concurrently
+        self.received = 0
+        self.delivered = 0
+
+    async def add(self, consumer, channels):
+        self.by_id.setdefault(consumer.consumer_id, set()).add(consumer)
+        self.by_name.setdefault(consumer.consumer_name, set()).add(consumer)
+        async with self.lock:
+            if self.pubsub is None:
+                self.channels = (*channels, self.front_channel)
+                self.redis_client = redis_pool.client()
+                self.delete_routes = self.redis_client.register_script(DELETE_ROUTES)
+                await self.subscribe()
+        if self.task is None or self.task.done():
+            self.task = create_task(self.listen())
+        if self.sessions_task is None or self.sessions_task.done():
+            self.sessions_task = create_task(self.keep_sessions())
+        # subscribed before the route exists: nothing sent to this replica is missed
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.set(id_route_key(consumer.consumer_id), self.front_channel, ex=ROUTE_TTL)
+            pipe.set(name_route_key(consumer.consumer_name), self.front_channel, ex=ROUTE_TTL)
+            await pipe.execute()
+
+    async def discard(self, consumer):
+        for index, key in ((self.by_id, consumer.consumer_id), (self.by_name, consumer.consumer_name)):
+            consumers = index.get(key)
+            if consumers is None:
+                continue
+            consumers.discard(consumer)
+            if not consumers:
+                del index[key]
+        gone = []
+        if consumer.consumer_id not in self.by_id:
+            gone.append(id_route_key(consumer.consumer_id))
+        if consumer.consumer_name not in self.by_name:
+            gone.append(name_route_key(consumer.consumer_name))
+        if gone and self.delete_routes:
+            try:
+                await self.delete_routes(keys=gone, args=[self.front_channel])
+            except Exception as e:
+                print(f"Route error : {e}")
+
+    async def keep_sessions(self):
+        """Refresh the routes and the presence (presence.py) of the users connected here, until they leave"""
+        while self.by_id:
+            await asleep(PRESENCE_REFRESH)
+            try:
+                async with self.redis_client.pipeline(transaction=False) as pipe:
+                    for user_id in self.by_id:
+                        pipe.set(id_route_key(user_id), self.front_channel, ex=ROUTE_TTL)
+                    for username in self.by_name:
+                        pipe.set(name_route_key(username), self.front_channel, ex=ROUTE_TTL)
+                    await pipe.execute()
+                await refresh_presence(self.redis_client, {
+                    consumer.consumer_id: consumer.presence_session
+                    for consumers in self.by_id.values() for consumer in consumers if consumer.presence_session
+                })
+            except Exception as e:
+                print(f"Session refresh error : {e}")
+
+    async def subscribe(self):
+        pubsub = redis_pool.pubsub(ignore_subscribe_messages=True)
+        await pubsub.subscribe(*self.channels)
+        self.pubsub = pubsub
+
+    async def reconnect(self):
+        pubsub, self.pubsub = self.pubsub, None
+        try:
+            await pubsub.close()
+        except Exception:
+            pass
+        await self.subscribe()
+
+    async def listen(self):
+        """Runs as long as the process: the subscription stays open without consumers,
+        messages must still be read or redis drops the connection."""
+        while True:
+            try:
+                message = await self.pubsub.get_message(timeout=1.0)
+            except CancelledError:
+                raise
+            except Exception as e:
+                print(f"Gateway listener error : {e}")
+                await asleep(1)
+                try:
+                    await self.reconnect()
+                except Exception as e:
+                    print(f"Gateway listener resubscribe error : {e}")
+                continue
+            if message is None or message["type"] != "message":
+                continue
+            self.received += 1
+            data = check_front_data(message["data"])
+            if data:
+                self.dispatch(data)
+
+    def recipients(self, id):
+        """Same rule as before: header.id is the username or the user id"""
+        consumers = set(self.by_name.get(str(id), ()))
+        try:
+            consumers.update(self.by_id.get(int(id), ()))
+        except (TypeError, ValueError):
+            pass
+        return consumers
+
+    def dispatch(self, data):
+        consumers = self.recipients(data['header']['id'])
+        if not consumers:
+            return
+        del data['header']['dest']
+        data['header'].pop('token', None)
+        text = dumps(data) # encoded once, whatever the number of sockets of the user
+        for consumer in consumers:
+            consumer.send_batched(text) # written by the consumer's own task
+            self.delivered += 1
+
+    def stats(self):
+        return {
+            "consumers": sum(len(consumers) for consumers in self.by_id.values()),
+            "received": self.received,
+            "delivered": self.delivered,
+        }
+
+
+# One per gateway process
+channel_listener = ChannelListener()
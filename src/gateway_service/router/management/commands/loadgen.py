@@ -0,0 +1,291 @@
+import json
+import ssl
+import jwt
+from asyncio import run as arun, create_task, gather, wait_for, sleep as asleep, TimeoutError as AsyncTimeoutError
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta, timezone
+from random import Random
+from struct import Struct
+from time import monotonic
+from uuid import uuid4
+import websockets # type: ignore
+from cryptography.hazmat.primitives.serialization import load_pem_private_key
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+# Header of the binary game frames, see game_service/game/frames.py
+FRAME_HEADER = Struct("<BBIIHH") # version, flags, sequence, time, left ack, right ack
+FRAME_VERSION = 3
+
+
+def percentile(values, p):
+    if not values:
+        return 0.0
+    values = sorted(values)
+    return values[min(len(values) - 1, int(p / 100 * len(values)))]
+
+
+def seq_reached(ack, seq):
+    """ack is seq or newer, on 16 bits sequence numbers that wrap around"""
+    return ((ack - seq) & 0xFFFF) < 0x8000
+
+
+class Stats:
+
+    def __init__(self):
+        self.latencies = defaultdict(list) # name -> seconds
+        self.counts = Counter()
+        self.errors = Counter()
+        self.open_sockets = 0
+
+    def record(self, name, seconds):
+        self.latencies[name].append(seconds)
+
+    def report(self, elapsed):
+        print(f"\n{'latency (ms)':32} {'count':>7} {'p50':>9} {'p90':>9} {'p99':>9} {'max':>9}")
+        for name, values in self.latencies.items():
+            ms = [v * 1000 for v in values]
+            print(f"{name:32} {len(ms):7} {percentile(ms, 50):9.1f} {percentile(ms, 90):9.1f} "
+                f"{percentile(ms, 99):9.1f} {max(ms):9.1f}")
+        for name, count in self.counts.items():
+            print(f"{name:32} {count:7}  ({count / elapsed:,.1f}/s)")
+        for name, count in self.errors.most_common():
+            print(f"error: {name:25} {count:7}")
+
+
+class Command(BaseCommand):
+    help = ("Open many authenticated websocket clients against the gateway and game routes, "
+        "and report end-to-end latencies. Run it inside the docker network, e.g. in the gateway container.")
+    requires_system_checks = []
+
+    def add_arguments(self, parser):
+        parser.add_argument("--url", default="wss://nginx", help="Where nginx serves /ws/ and /game/")
+        parser.add_argument("--flow", choices=["gateway", "game"], default="game",
+            help="gateway: queue for 1vs1R through matchmaking then play (the users must exist in the database). "
+                "game: pairs of clients play directly, with tickets signed here (no matchmaking, no database)")
+        parser.add_argument("--clients", type=int, default=1000)
+        parser.add_argument("--ramp", type=float, default=30.0, help="Seconds to open every client")
+        parser.add_argument("--duration", type=float, default=120.0, help="Seconds before every client is closed")
+        parser.add_argument("--inputs", type=float, default=4.0, help="Input changes per player per second")
+        parser.add_argument("--first-id", type=int, default=900000, help="User id of the first client")
+        parser.add_argument("--first-game-id", type=int, default=900000000,
+            help="--flow game: id of the first game. Their scores are published to matchmaking, which doesn't know them")
+        parser.add_argument("--no-play", action="store_true", help="--flow gateway: stop once matched")
+        parser.add_argument("--insecure", action="store_true", help="Don't verify the certificate of nginx")
+        parser.add_argument("--seed", type=int, default=42)
+
+    def handle(self, *args, **options):
+        if not settings.FRONTEND_JWT["PRIVATE_KEY"]:
+            raise CommandError("JWT_PRIVATE_KEY is needed to sign the access tokens of the clients")
+        if options["flow"] == "game" and not settings.BACKEND_JWT["PRIVATE_KEY"]:
+            raise CommandError("BACKEND_JWT_PRIVATE_KEY is needed to sign the game tickets")
+        self.options = options
+        # parsed once: loading a PEM on every jwt.encode() blocks the loop for tens of ms
+        self.frontend_key = load_pem_private_key(settings.FRONTEND_JWT["PRIVATE_KEY"].encode(), None)
+        self.backend_key = options["flow"] == "game" and load_pem_private_key(settings.BACKEND_JWT["PRIVATE_KEY"].encode(), None)
+        self.url = options["url"].rstrip("/")
+        self.origin = "https://" + self.url.split("://", 1)[-1] # checked by AllowedHostsOriginValidator
+        self.ssl = ssl.create_default_context(cafile="/etc/ssl/ca.crt") if self.url.startswith("wss") else None
+        if self.ssl and options["insecure"]:
+            self.ssl.check_hostname = False
+            self.ssl.verify_mode = ssl.CERT_NONE
+        self.rng = Random(options["seed"])
+        self.stats = Stats()
+        arun(self.run())
+
+    async def run(self):
+        options = self.options
+        start = monotonic()
+        self.deadline = start + options["duration"]
+        clients = []
+        for i in range(options["clients"]):
+            player_id = options["first_id"] + i
+            delay = options["ramp"] * i / options["clients"]
+            if options["flow"] == "gateway":
+                clients.append(create_task(self.later(delay, self.gateway_client(player_id))))
+            else:
+                clients.append(create_task(self.later(delay, self.direct_game_client(player_id, i))))
+        progress = create_task(self.progress(start))
+        await gather(*clients, return_exceptions=True)
+        progress.cancel()
+        self.stats.report(monotonic() - start)
+
+    async def later(self, delay, coroutine):
+        await asleep(delay)
+        await coroutine
+
+    async def progress(self, start):
+        while True:
+            await asleep(5)
+            print(f"{monotonic() - start:6.0f}s  {self.stats.open_sockets} open sockets, "
+                f"{sum(self.stats.errors.values())} errors")
+
+    def access_token(self, player_id):
+        now = datetime.now(timezone.utc)
+        payload = { # same claims as the access tokens of auth
+            "id": player_id,
+            "uuid": str(uuid4()),
+            "username": f"load{player_id}",
+            "exp": now + timedelta(seconds=self.options["ramp"] + self.options["duration"] + 60),
+            "iat": now,
+            "jti": str(uuid4()),
+            "typ": "user",
+            "oauth": False,
+            "avatar": None,
+        }
+        return jwt.encode(payload, self.frontend_key, algorithm=settings.FRONTEND_JWT["ALGORITHM"])
+
+    def game_ticket(self, player_id, game_id, players):
+        payload = { # same claims as game_ticket() in matchmaking's listenredis.py
+            "service": "matchmaking",
+            "scope": "game",
+            "game_id": game_id,
+            "player_id": player_id,
+            "players": players,
+            "side": 0 if player_id == min(players) else 1,
+            "exp": datetime.now(timezone.utc) + timedelta(seconds=self.options["ramp"] + 60),
+        }
+        return jwt.encode(payload, self.backend_key, algorithm=settings.BACKEND_JWT["ALGORITHM"])
+
+    def connect(self, path):
+        return websockets.connect(self.url + path, ssl=self.ssl, origin=self.origin,
+            open_timeout=30, max_size=2 ** 16)
+
+    async def recv(self, ws):
+        """Next message, or None once the run is over"""
+        try:
+            return await wait_for(ws.recv(), max(0, self.deadline - monotonic()))
+        except AsyncTimeoutError:
+            return None
+
+    async def gateway_client(self, player_id):
+        stats = self.stats
+        start = monotonic()
+        try:
+            async with self.connect(f"/ws/?t={self.access_token(player_id)}") as ws:
+                stats.record("gateway connect", monotonic() - start)
+                stats.open_sockets += 1
+                try:
+                    await self.queue(ws, player_id)
+                finally:
+                    stats.open_sockets -= 1
+        except Exception as e:
+            stats.errors[f"gateway: {type(e).__name__}"] += 1
+
+    async def queue(self, ws, player_id):
+        stats = self.stats
+        start = monotonic()
+        await ws.send(json.dumps({
+            "header": {"service": "mmaking", "dest": "back", "id": player_id},
+            "body": {"status": "online", "type_game": "1vs1R"},
+        }))
+        while True:
+            message = await self.recv(ws)
+            if message is None:
+                stats.errors["not matched in time"] += 1
+                return
+            data = json.loads(message)
+            if data.get("action") == "disconnect":
+                stats.errors["kicked by the gateway"] += 1
+                return
+            body = self.ingame(data.get("batch", [data]))
+            if body:
+                break
+        stats.record("matchmaking (queue to ingame)", monotonic() - start)
+        if self.options["no_play"]:
+            await self.recv(ws) # stay online until the end
+            return
+        await ws.send(json.dumps({ # like mmaking.js socketGameGood()
+            "header": {"service": "mmaking", "dest": "back", "id": player_id},
+            "body": {"GameSocket": True, "gameId": body["id_game"]},
+        }))
+        await self.game_client(player_id, body["id_game"], body.get("ticket"))
+
+    async def direct_game_client(self, player_id, i):
+        """--flow game: clients 2n and 2n+1 play game first_game_id + n"""
+        game_id = self.options["first_game_id"] + i // 2
+        opponent_id = player_id + 1 if i % 2 == 0 else player_id - 1
+        await self.game_client(player_id, game_id, self.game_ticket(player_id, game_id, [player_id, opponent_id]))
+
+    def ingame(self, messages):
+        """Body of the message announcing the game, if in messages"""
+        for data in messages:
+            body = data.get("body", {})
+            if data.get("header", {}).get("service") == "mmaking" and body.get("status") == "ingame" and body.get("id_game"):
+                return body
+        return None
+
+    async def game_client(self, player_id, game_id, ticket):
+        stats = self.stats
+        path = f"/game/{game_id}/?t={self.access_token(player_id)}"
+        if ticket:
+            path += f"&ticket={ticket}"
+        start = monotonic()
+        try:
+            async with self.connect(path) as ws:
+                stats.record("game connect", monotonic() - start)
+                stats.open_sockets += 1
+                try:
+                    await self.play(ws)
+                finally:
+                    stats.open_sockets -= 1
+        except Exception as e:
+            stats.errors[f"game: {type(e).__name__}"] += 1
+
+    async def play(self, ws):
+        stats = self.stats
+        side = None
+        pending = {} # seq -> send time
+        sent = monotonic()
+        loaded_at = None
+        last_frame = None
+        await ws.send(json.dumps({"action": "wannaplay!"}))
+        inputs = create_task(asleep(0))
+        try:
+            while True:
+                message = await self.recv(ws)
+                now = monotonic()
+                if message is None:
+                    return
+                if isinstance(message, bytes):
+                    version, _, _, _, *acks = FRAME_HEADER.unpack_from(message)
+                    if version != FRAME_VERSION or side is None:
+                        stats.errors["unexpected frame"] += 1
+                        continue
+                    stats.counts["frames received"] += 1
+                    if loaded_at is not None:
+                        stats.record("load_complete to 1st frame", now - loaded_at) # includes the countdown
+                        loaded_at = None
+                        inputs = create_task(self.send_inputs(ws, pending))
+                    elif last_frame is not None:
+                        stats.record("frame interval", now - last_frame)
+                    last_frame = now
+                    for seq in [seq for seq in pending if seq_reached(acks[side], seq)]:
+                        stats.record("input to ack in a frame", now - pending.pop(seq))
+                    continue
+                data = json.loads(message)
+                action = data.get("action")
+                if action == "init":
+                    stats.record("wannaplay! to init", now - sent)
+                    side = int(data["side"])
+                    await ws.send(json.dumps({"action": "load_complete"}))
+                    loaded_at = monotonic()
+                elif action == "wait":
+                    last_frame = None # the pause is not a frame interval
+                elif action == "game_won":
+                    stats.counts["games finished"] += 1
+                elif action == "game_cancelled":
+                    stats.errors["game cancelled"] += 1
+                elif action == "disconnect":
+                    return
+        finally:
+            inputs.cancel()
+
+    async def send_inputs(self, ws, pending):
+        seq = 0
+        while True:
+            await asleep(self.rng.expovariate(self.options["inputs"]))
+            seq = (seq + 1) & 0xFFFF
+            pending[seq] = monotonic()
+            await ws.send(json.dumps({"action": "move", "key": self.rng.choice([-1, 0, 1]), "seq": seq}))
+            self.stats.counts["inputs sent"] += 1
@@ -1,7 +1,6 @@
 from urllib.parse import parse_qs
 import jwt
-import requests
-from django.conf import settings
+from .keys import key_provider
 
 class JWTAuthMiddleware:
     """Middleware ASGI to authentify WebSocket connection with JWT."""
@@ -16,7 +15,10 @@ class JWTAuthMiddleware:
 
         if token:
             try:
-                public_key = self.get_public_key()
+                kid = jwt.get_unverified_header(token).get("kid")
+                public_key = await key_provider.get_key(kid)
+                if public_key is None:
+                    raise jwt.InvalidTokenError("No public key")
                 payload = jwt.decode(token, public_key, algorithms=["RS256"])
                 scope["payload"] = payload
             except jwt.ExpiredSignatureError:
@@ -30,21 +32,3 @@ class JWTAuthMiddleware:
             scope["payload"] = None
 
         return await self.app(scope, receive, send)
-
-    def get_public_key(self):
-        try:
-            url = "https://nginx:8443/api/v1/auth/public-key/"
-            response = requests.get(
-                url,
-                timeout=10,
-                cert=("/etc/ssl/gateway.crt", "/etc/ssl/gateway.key"),
-                verify="/etc/ssl/ca.crt"
-            )
-            
-            if response.status_code == 200:
-                return response.json().get("public_key")
-            else:
-                raise RuntimeError("Impossible de récupérer la clé publique JWT")
-        except RuntimeError as e:
-            print(e)
-            raise(e)
\ No newline at end of file
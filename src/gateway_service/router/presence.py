@@ -0,0 +1,64 @@
+# Who is connected, and where.
+#
+# presence_<user id> holds the session of the user's websocket: the channel of
+# its gateway process and an id of the connection. It is claimed with SET NX when
+# the socket connects, so that a second socket of the same user is refused in a
+# single round trip, and deleted when the socket closes. The gateway renews it
+# every PRESENCE_REFRESH seconds (listener.py): the presence of a crashed gateway
+# expires after PRESENCE_TTL.
+#
+# Read directly by auth (LoginView) and social, with the same key.
+
+from uuid import uuid4
+
+PRESENCE_TTL = 30 # seconds
+PRESENCE_REFRESH = 10 # seconds
+
+# Only the session that holds the presence may renew or delete it
+REFRESH_PRESENCE = """
+for i, key in ipairs(KEYS) do
+    if redis.call('GET', key) == ARGV[i + 1] then
+        redis.call('EXPIRE', key, ARGV[1])
+    end
+end
+"""
+
+RELEASE_PRESENCE = """
+if redis.call('GET', KEYS[1]) == ARGV[1] then
+    return redis.call('DEL', KEYS[1])
+end
+return 0
+"""
+
+_scripts = {}
+
+
+def presence_key(user_id):
+    return f"presence_{user_id}"
+
+
+def new_session(node):
+    return f"{node}/{uuid4().hex}"
+
+
+def script(redis_client, source):
+    if source not in _scripts:
+        _scripts[source] = redis_client.register_script(source)
+    return _scripts[source]
+
+
+async def claim_presence(redis_client, user_id, session):
+    """True if the user had no other session, which is now this one"""
+    return bool(await redis_client.set(presence_key(user_id), session, nx=True, ex=PRESENCE_TTL))
+
+
+async def refresh_presence(redis_client, sessions):
+    """sessions: {user id: session} of the sockets of this process"""
+    if sessions:
+        await script(redis_client, REFRESH_PRESENCE)(
+            keys=[presence_key(user_id) for user_id in sessions],
+            args=[PRESENCE_TTL, *sessions.values()], client=redis_client)
+
+
+async def release_presence(redis_client, user_id, session):
+    await script(redis_client, RELEASE_PRESENCE)(keys=[presence_key(user_id)], args=[session], client=redis_client)
@@ -1,5 +1,6 @@
 import asyncio
 import json
+from ...front_route import publish_front
 from .Player import Player
 
 class Guest(Player):
@@ -24,7 +25,7 @@ class Guest(Player):
         }
         data['body']['opponents'] = self.salon.getDictPlayers()
         del data['body']['opponents'][id]
-        await self.redis.publish(self.channelFront, json.dumps(data))
+        await publish_front(self.redis, self.channelFront, data)
 
     async def start_1vs1RtoSocial(self, id):
         data = {
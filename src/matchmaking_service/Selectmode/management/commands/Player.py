@@ -5,6 +5,7 @@ from django.core.cache import cache
 from django.conf import settings
 #from .Guest import Guest
 import jwt
+from ...streams import add_to_stream
 import logging
 
 from datetime import datetime, timedelta, timezone
@@ -114,7 +115,7 @@ class Player ():
                 'from': 'mmaking' # mdjemaa
             }
         }
-        await redis.publish(channel, json.dumps(data))
+        await add_to_stream(redis, channel, data)
 
     def get_friend_list(self):
         """ Request friendlist from container 'users' """
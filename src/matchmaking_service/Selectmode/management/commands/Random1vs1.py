@@ -1,5 +1,6 @@
 import asyncio
 import json
+from ...front_route import publish_front
 from .Salon import Salon
 from .Player import Player
 import itertools
@@ -54,7 +55,7 @@ class Random1vs1():
         }
         data['body']['opponents'] = self.salon.getDictPlayers()
         del data['body']['opponents'][id]
-        await self.redis.publish(self.channelFront, json.dumps(data))
+        await publish_front(self.redis, self.channelFront, data)
 
     async def start_1vs1RtoSocial(self, id):
         data = {
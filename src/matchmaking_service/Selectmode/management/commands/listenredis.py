@@ -1,5 +1,6 @@
 from django.core.management.base import BaseCommand
-from redis.asyncio import from_url
+from ...redis_pool import redis_pool
+from ...front_route import publish_front
 import threading
 import json
 import asyncio
@@ -22,6 +23,8 @@ from .Random1vs1 import Random1vs1
 class Command(BaseCommand):
     help = "Commande pour écouter un canal Redis avec Pub/Sub"   
 
+    GAME_TICKET_TTL = 60 # seconds, for the client to open its game socket
+
     def handle(self, *args, **kwargs):
         signal(SIGINT, self.signal_handler)
         signal(SIGTERM, self.signal_handler)
@@ -30,16 +33,14 @@ class Command(BaseCommand):
     async def main(self):
         self.running = True
         try:
-            REDIS_PASSWORD = settings.REDIS_PASSWORD
-
-            self.redis_client = await from_url(f"redis://:{REDIS_PASSWORD}@redis:6379", decode_responses=True)
+            self.redis_client = redis_pool.client()
             
-            self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+            self.pubsub = redis_pool.pubsub(ignore_subscribe_messages=True)
             
             # All channels
             self.channel_front = "deep_mmaking"
             self.channel_social = "info_social"
-            self.channel_deepSocial = "deep_social"
+            self.channel_deepSocial = "deep_social_stream" # a stream, see streams.py
             self.channel_pong = "info_mmaking"
             
             # Data to save all salon by the type_game
@@ -121,8 +122,7 @@ class Command(BaseCommand):
             await self.pubsub.unsubscribe(self.channel_front)
             await self.pubsub.unsubscribe(self.channel_social)
             await self.pubsub.close()
-        if self.redis_client:
-            await self.redis_client.close()
+        await redis_pool.close()
             
     #############      GENERAL     #############
     
@@ -1116,7 +1116,8 @@ class Command(BaseCommand):
                 'id_game': gameid,
                 player.type_game: True,
                 'tournament': True,
-                'cancel': False
+                'cancel': False,
+                'ticket': await self.game_ticket(id, gameid),
             }
         }
         salonNumber = 1
@@ -1128,7 +1129,7 @@ class Command(BaseCommand):
             salonNumber = salonNumber + 1
 
         data['body']['opponents'] = bracket
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
         
     async def sendEndTournamentWithBracketJSON(self, id, player, gameid, tournamentId, winnerId):
         data = {
@@ -1155,7 +1156,7 @@ class Command(BaseCommand):
 
         data['body']['opponents'] = bracket
         data['body']['winnerId'] = winnerId
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
 
     # Send status ingame to Front to start a game with all opponents
     async def start_toFront(self, id, player, gameid):
@@ -1169,7 +1170,8 @@ class Command(BaseCommand):
                 'status': 'ingame',
                 'id_game': gameid,
                 player.type_game: True,
-                'cancel': False
+                'cancel': False,
+                'ticket': await self.game_ticket(id, gameid),
             }
         }
         salonNumber = 1
@@ -1179,7 +1181,7 @@ class Command(BaseCommand):
             salonNumber = salonNumber + 1
 
         data['body']['opponents'] = bracket
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
 
 
     # Send invitation game to Client
@@ -1199,7 +1201,7 @@ class Command(BaseCommand):
                 'cancel': False
             }
         }
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
         
     async def invitationGameToHost(self, host, guest, accept):
         data = {
@@ -1218,7 +1220,7 @@ class Command(BaseCommand):
                 'cancel': False
             }
         }
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
 
     # Confirm to host the invitation is send to Guest
     async def confirmSendInvitationGame(self, hostid, guestid, accept):
@@ -1237,7 +1239,7 @@ class Command(BaseCommand):
                 'cancel': False
             }
         }
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
         
     async def cancelInvitation(self, hostid, guestid, to):
         data = {
@@ -1253,7 +1255,7 @@ class Command(BaseCommand):
                 'cancel': True
             }
         }
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
 
     async def cancelSalonInvitation(self, hostid, guestid, to):
         data = {
@@ -1270,7 +1272,7 @@ class Command(BaseCommand):
                 'cancel': True
             }
         }
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
         
         
     # Send status ingame to Social to setup status in front
@@ -1299,7 +1301,7 @@ class Command(BaseCommand):
                 'cancel': True
             }
         }
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
         
         
     async def JSON_endgameWithoutError(self, id):
@@ -1315,7 +1317,7 @@ class Command(BaseCommand):
                 'tournament': True,
             }
         }
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
         
     async def JSON_endgameWinnerTournament(self, id, winnerId):
         data = {
@@ -1330,7 +1332,7 @@ class Command(BaseCommand):
                 'winnerId': winnerId
             }
         }
-        await self.redis_client.publish(self.channel_front, json.dumps(data))
+        await publish_front(self.redis_client, self.channel_front, data)
         
         
 
@@ -1552,6 +1554,26 @@ class Command(BaseCommand):
             return
         key = f"game_{game_id}_players"
         await self.redis_client.set(key, json.dumps(players), ex = 2)
+
+    async def game_ticket(self, player_id, game_id):
+        """ Short-lived signed admission to game_id, checked by game_service without asking us """
+        players = await sync_to_async(self.getplayers)(game_id)
+        if not players:
+            return None
+        payload = {
+            "service": "matchmaking",
+            "scope": "game",
+            "game_id": int(game_id),
+            "player_id": player_id,
+            "players": players,
+            "side": 0 if player_id == min(players) else 1, # game_service: lower id plays left
+            "exp": datetime.now(timezone.utc) + timedelta(seconds=self.GAME_TICKET_TTL),
+        }
+        return jwt.encode(
+            payload,
+            settings.BACKEND_JWT["PRIVATE_KEY"],
+            algorithm=settings.BACKEND_JWT["ALGORITHM"],
+        )
         
     #############       Communication with Game     #############
 
@@ -0,0 +1,123 @@
+# One redis connection pool per process, shared by every consumer and task.
+#
+# Opening a client per websocket costs one or more redis connections per user.
+# Instead, commands borrow a connection from a bounded pool for the time of the
+# command, and pub/sub subscriptions (which keep their connection) come from a
+# second, larger pool. Blocking commands (BLPOP), which hold their connection
+# until they return, get a third pool of their own: waiters can't starve the
+# commands of everybody else. The pools are blocking: when they are full, callers
+# wait up to POOL_TIMEOUT seconds for a connection instead of opening a new one.
+#
+# The shared clients must not be closed by their users, only by redis_pool.close()
+# when the process stops.
+
+import os
+from time import monotonic
+from redis.asyncio import Redis, BlockingConnectionPool #type: ignore
+from redis.exceptions import ConnectionError #type: ignore
+from django.conf import settings
+
+MAX_CONNECTIONS = int(os.getenv("REDIS_MAX_CONNECTIONS", "64"))
+MAX_PUBSUB_CONNECTIONS = int(os.getenv("REDIS_MAX_PUBSUB_CONNECTIONS", "1024"))
+MAX_BLOCKING_CONNECTIONS = int(os.getenv("REDIS_MAX_BLOCKING_CONNECTIONS", "1024")) # e.g. one per player waiting for an opponent (game)
+POOL_TIMEOUT = 5 # seconds waiting for a free connection
+HEALTH_CHECK_INTERVAL = 30 # seconds, idle connections are PINGed before reuse
+CONNECT_TIMEOUT = 5 # seconds
+
+
+class MeteredPool(BlockingConnectionPool):
+    """BlockingConnectionPool that counts what happens to its connections."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.created = 0
+        self.in_use = 0
+        self.acquired = 0
+        self.failures = 0 # no connection within POOL_TIMEOUT, or could not connect
+        self.total_wait = 0.0
+        self.max_wait = 0.0
+
+    def make_connection(self):
+        self.created += 1
+        return super().make_connection()
+
+    async def get_connection(self, *args, **kwargs):
+        start = monotonic()
+        try:
+            connection = await super().get_connection(*args, **kwargs)
+        except ConnectionError:
+            self.failures += 1
+            raise
+        wait = monotonic() - start
+        self.acquired += 1
+        self.in_use += 1
+        self.total_wait += wait
+        self.max_wait = max(self.max_wait, wait)
+        return connection
+
+    async def release(self, connection):
+        self.in_use = max(0, self.in_use - 1)
+        await super().release(connection)
+
+    def stats(self):
+        return {
+            "max_connections": self.max_connections,
+            "created": self.created,
+            "in_use": self.in_use,
+            "acquired": self.acquired,
+            "failures": self.failures,
+            "average_wait": self.total_wait / self.acquired if self.acquired else 0.0,
+            "max_wait": self.max_wait,
+        }
+
+
+class RedisPool:
+    """Shared redis clients of this process, by (kind of pool, decode_responses)."""
+
+    MAX_CONNECTIONS = {
+        "commands": MAX_CONNECTIONS,
+        "pubsub": MAX_PUBSUB_CONNECTIONS,
+        "blocking": MAX_BLOCKING_CONNECTIONS,
+    }
+
+    def __init__(self):
+        self.clients = {}
+
+    def url(self):
+        return f"redis://:{settings.REDIS_PASSWORD}@redis:6379"
+
+    def client(self, decode_responses=True, pubsub=False, blocking=False) -> Redis:
+        """blocking: for the commands that wait on the server, like BLPOP"""
+        kind = "pubsub" if pubsub else "blocking" if blocking else "commands"
+        key = (kind, decode_responses)
+        if key not in self.clients:
+            pool = MeteredPool.from_url(
+                self.url(),
+                max_connections=self.MAX_CONNECTIONS[kind],
+                timeout=POOL_TIMEOUT,
+                health_check_interval=HEALTH_CHECK_INTERVAL,
+                socket_connect_timeout=CONNECT_TIMEOUT,
+                socket_keepalive=True,
+                decode_responses=decode_responses,
+            )
+            self.clients[key] = Redis(connection_pool=pool)
+        return self.clients[key]
+
+    def pubsub(self, decode_responses=True, **kwargs):
+        """A PubSub holding one connection of the pub/sub pool until it is closed."""
+        return self.client(decode_responses, pubsub=True).pubsub(**kwargs)
+
+    def stats(self):
+        return {
+            kind + ("" if decode else "_binary"): client.connection_pool.stats()
+            for (kind, decode), client in self.clients.items()
+        }
+
+    async def close(self):
+        clients, self.clients = self.clients, {}
+        for client in clients.values():
+            await client.connection_pool.disconnect()
+
+
+# One per process
+redis_pool = RedisPool()
@@ -0,0 +1,105 @@
+# Work queues from the gateway (and matchmaking) to the chat and social workers.
+#
+# Pub/sub delivers a message to every subscriber that is connected at that
+# moment: one worker of each kind at most, and nothing while it restarts. The
+# back-bound messages go to redis streams instead (deep_chat_stream,
+# deep_social_stream), read through a consumer group: each entry is handled by
+# one of the workers of the group, and acknowledged once handled.
+#
+# Entries not acknowledged after CLAIM_IDLE (a worker crashed or is stuck) are
+# claimed by another worker, up to MAX_DELIVERIES times, then dropped.
+# Front-bound answers still go through pub/sub (front_route.py).
+#
+# Same file in every service that produces or consumes these streams.
+
+import json
+import os
+import socket
+from asyncio import sleep as asleep, CancelledError
+from time import monotonic
+from redis.exceptions import ResponseError #type: ignore
+
+STREAM_MAXLEN = 10000 # entries kept per stream, acknowledged or not
+GROUP = "workers"
+BLOCK = 1000 # ms waiting for new entries
+COUNT = 32 # entries per read
+CLAIM_IDLE = 30000 # ms before an unacknowledged entry is given to another worker
+CLAIM_INTERVAL = 5 # seconds between two looks at the stuck entries
+MAX_DELIVERIES = 5
+
+
+async def add_to_stream(redis_client, stream, data):
+    return await redis_client.xadd(stream, {"data": json.dumps(data)}, maxlen=STREAM_MAXLEN, approximate=True)
+
+
+class StreamConsumer:
+    """Reads a stream as one consumer of GROUP, and calls handle(data, entry_id) for each entry.
+    Entry ids grow with the order of the entries in the stream, whichever worker handles them."""
+
+    def __init__(self, redis_client, stream, handle):
+        self.redis_client = redis_client
+        self.stream = stream
+        self.handle = handle
+        self.name = f"{socket.gethostname()}_{os.getpid()}"
+        self.last_claim = 0
+        self.handled = 0
+        self.claimed = 0
+        self.dropped = 0
+
+    async def create_group(self):
+        try:
+            # "0": the entries written before the first worker started are handled too
+            await self.redis_client.xgroup_create(self.stream, GROUP, id="0", mkstream=True)
+        except ResponseError as e:
+            if "BUSYGROUP" not in str(e): # created by another worker
+                raise
+
+    async def run(self):
+        await self.create_group()
+        print(f"Consuming stream {self.stream} as {self.name}")
+        while True:
+            try:
+                if monotonic() - self.last_claim > CLAIM_INTERVAL:
+                    self.last_claim = monotonic()
+                    await self.claim()
+                response = await self.redis_client.xreadgroup(GROUP, self.name, {self.stream: ">"}, count=COUNT, block=BLOCK)
+                for _, entries in response or ():
+                    await self.process(entries)
+            except CancelledError:
+                raise
+            except ResponseError as e:
+                if "NOGROUP" in str(e): # the stream was deleted
+                    await self.create_group()
+                    continue
+                print(f"Stream {self.stream} error : {e}")
+                await asleep(1)
+            except Exception as e:
+                print(f"Stream {self.stream} error : {e}")
+                await asleep(1)
+
+    async def claim(self):
+        """Take over the entries another worker did not acknowledge in time"""
+        pending = await self.redis_client.xpending_range(self.stream, GROUP, min="-", max="+", count=COUNT, idle=CLAIM_IDLE)
+        if not pending:
+            return
+        dropped = [entry["message_id"] for entry in pending if entry["times_delivered"] >= MAX_DELIVERIES]
+        if dropped:
+            print(f"Stream {self.stream}: dropping {len(dropped)} entries delivered {MAX_DELIVERIES} times")
+            await self.redis_client.xack(self.stream, GROUP, *dropped)
+            self.dropped += len(dropped)
+        retry = [entry["message_id"] for entry in pending if entry["times_delivered"] < MAX_DELIVERIES]
+        if retry:
+            entries = await self.redis_client.xclaim(self.stream, GROUP, self.name, CLAIM_IDLE, retry)
+            self.claimed += len(entries)
+            await self.process(entries)
+
+    async def process(self, entries):
+        for entry_id, fields in entries:
+            if fields: # None when the entry was trimmed before being claimed
+                try:
+                    await self.handle(json.loads(fields["data"]), entry_id)
+                except Exception as e:
+                    print(f"Stream {self.stream} entry {entry_id} : {e}")
+                    continue # left pending, retried by claim()
+            await self.redis_client.xack(self.stream, GROUP, entry_id)
+            self.handled += 1
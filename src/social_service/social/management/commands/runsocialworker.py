@@ -2,14 +2,50 @@ import json
 import requests
 from signal import signal, SIGTERM, SIGINT
 from django.core.management.base import BaseCommand
-from redis.asyncio import from_url
+from ...redis_pool import redis_pool
+from ...front_route import publish_front
+from ...streams import StreamConsumer
 from asyncio import run as arun, sleep as asleep, create_task
 from django.conf import settings
 from django.core.cache import cache
 import jwt
 from datetime import datetime, timedelta, timezone
+
+# user id -> status, shared by every social worker. Users not in it are offline.
+USER_STATUS = "social_user_status"
+# user id -> id of the stream entry that set its status. The entries of a user can be
+# handled by different workers, or retried: an older one must not undo a newer one.
+USER_STATUS_ENTRY = "social_user_status_entry"
+
+# Sets the status of ARGV[1] to ARGV[2] unless a newer entry (ARGV[3]) set it already.
+# Returns {1, previous status} if applied, {0} if not.
+UPDATE_STATUS = """
+local last = redis.call('HGET', KEYS[2], ARGV[1])
+if last then
+    local last_ms, last_seq = string.match(last, '(%d+)-(%d+)')
+    local ms, seq = string.match(ARGV[3], '(%d+)-(%d+)')
+    if tonumber(ms) < tonumber(last_ms) or (ms == last_ms and tonumber(seq) <= tonumber(last_seq)) then
+        return {0}
+    end
+end
+local previous = redis.call('HGET', KEYS[1], ARGV[1]) or ''
+redis.call('HSET', KEYS[2], ARGV[1], ARGV[3])
+if ARGV[2] == 'offline' then
+    redis.call('HDEL', KEYS[1], ARGV[1])
+else
+    redis.call('HSET', KEYS[1], ARGV[1], ARGV[2])
+end
+return {1, previous}
+"""
+
+
+def presence_key(user_id):
+    """Set by the gateway while the user has a socket, see gateway_service/router/presence.py"""
+    return f"presence_{user_id}"
+
+
 class Command(BaseCommand):
-    help = "Async pub/sub redis worker. Listens 'deep_social' channel"
+    help = "Async redis worker. Handles the 'deep_social_stream' stream as one of the social workers, answers 'info_social' and 'auth_social'"
 
     def handle(self, *args, **kwargs):
         signal(SIGINT, self.signal_handler)
@@ -18,7 +54,6 @@ class Command(BaseCommand):
 
     async def main(self):
         self.running = True
-        self.user_status = {}
         try:
             await self.connect_redis()
             while self.running:
@@ -29,19 +64,21 @@ class Command(BaseCommand):
             await self.cleanup_redis()
 
     async def connect_redis(self):
-        REDIS_PASSWORD = settings.REDIS_PASSWORD
-
-        self.redis_client = await from_url(f"redis://:{REDIS_PASSWORD}@redis:6379", decode_responses=True)
+        self.redis_client = redis_pool.client()
         
-        self.pubsub = self.redis_client.pubsub(ignore_subscribe_messages=True)
+        self.pubsub = redis_pool.pubsub(ignore_subscribe_messages=True)
         self.REDIS_GROUPS = {
-            "gateway": "deep_social",
+            "gateway": "deep_social", # answers, see front_route.py
             "info": "info_social",
             "auth": "auth_social",
         }
-        print(f"Subscribing to channels: {', '.join(self.REDIS_GROUPS.values())}")
-        await self.pubsub.subscribe(*self.REDIS_GROUPS.values())
+        # every worker answers the status requests, from the shared USER_STATUS
+        print(f"Subscribing to channels: {self.REDIS_GROUPS['info']}, {self.REDIS_GROUPS['auth']}")
+        await self.pubsub.subscribe(self.REDIS_GROUPS['info'], self.REDIS_GROUPS['auth'])
         self.listen_task = create_task(self.listen())
+        self.update_status_script = self.redis_client.register_script(UPDATE_STATUS)
+        self.stream = StreamConsumer(self.redis_client, "deep_social_stream", self.handle_entry)
+        self.stream_task = create_task(self.stream.run())
 
     async def listen(self):
         print(f"Listening for messages...")
@@ -56,12 +93,17 @@ class Command(BaseCommand):
                     if channel == self.REDIS_GROUPS['auth']:
                         await self.auth_process(data)
                         continue
-                    if self.valid_social_json(data):
-                        await self.social_process(data)
-                        continue
                 except Exception as e:
                     print(e)
 
+    async def handle_entry(self, data, entry_id):
+        try:
+            valid = self.valid_social_json(data)
+        except (KeyError, TypeError):
+            valid = False
+        if valid:
+            await self.social_process(data, entry_id)
+
     def valid_social_json(self, data):
         if data['header']['dest'] != 'back' or data['header']['service'] != 'social':
             return False
@@ -81,41 +123,66 @@ class Command(BaseCommand):
         if not from_id:
             return
         data = self.build_notify_data(user_id, from_id)
-        await self.redis_client.publish(self.REDIS_GROUPS['gateway'], json.dumps(data))
+        await publish_front(self.redis_client, self.REDIS_GROUPS['gateway'], data)
 
-    async def social_process(self, data):
+    async def social_process(self, data, entry_id):
         user_id = data['header']['id']
-        if data['body'].get('from') == 'mmaking' and self.user_status.get(user_id, "offline") == "offline":
+        if data['body'].get('from') == 'mmaking' and await self.stored_status(user_id) == "offline":
             return
         if data['body']['status'] == 'notify':
            await self.notifyUser(data)
            return
         friends_data = self.get_friend_list(user_id)
         if not friends_data:
-            await self.update_status(user_id, data['body']['status'])
+            await self.update_status(user_id, data['body']['status'], entry_id)
             return
         friends = [item['id'] for item in friends_data]
         if data['body']['status'] == 'info': # User's first connection, get all friends status
             await self.send_me_my_friends_status(user_id, friends)
         else:
-            await self.update_status(user_id, data['body']['status'])
-            for friend in friends:
-                if self.user_status.get(friend, "offline") != 'offline':
-                    await self.send_my_status(user_id, friend)
+            if not await self.update_status(user_id, data['body']['status'], entry_id):
+                return
+            status = data['body']['status']
+            for friend, friend_status in zip(friends, await self.get_statuses(friends)):
+                if friend_status != 'offline':
+                    await self.send_my_status(user_id, friend, status)
+
+    async def stored_status(self, user_id):
+        return await self.redis_client.hget(USER_STATUS, user_id) or "offline"
+
+    async def get_status(self, user_id):
+        return (await self.get_statuses([user_id]))[0]
 
-    async def update_status(self, user_id, status):
-        """ Update self.user_status map.\n
+    async def get_statuses(self, user_ids):
+        """Statuses shown to the others: users without a presence are offline,
+        whatever a gateway that crashed left in USER_STATUS"""
+        if not user_ids:
+            return []
+        async with self.redis_client.pipeline(transaction=False) as pipe:
+            pipe.hmget(USER_STATUS, user_ids)
+            for user_id in user_ids:
+                pipe.exists(presence_key(user_id))
+            statuses, *present = await pipe.execute()
+        return [(status or "online") if here else "offline" for status, here in zip(statuses, present)]
+
+    async def update_status(self, user_id, status, entry_id):
+        """ Update USER_STATUS, unless a newer stream entry did already: False then.\n
         If user was pending and goes offline, we have to report this to mmaking container """
         if status == "info":
-            return
-        if status == "offline" and self.user_status.get(user_id) == "pending":
+            return True
+        applied, *previous = await self.update_status_script(
+            keys=[USER_STATUS, USER_STATUS_ENTRY], args=[user_id, status, entry_id])
+        if not applied:
+            print(f"User {user_id}: status '{status}' of entry {entry_id} is outdated")
+            return False
+        if status == "offline" and previous[0] == "pending":
             await self.redis_client.publish(self.REDIS_GROUPS['info'], json.dumps({
                 "user_id": user_id,
                 "status": "offline"
             }))
-        self.user_status[user_id] = status # Update current user status
         # print(f"User {user_id} is now {status}")
-        await self.send_me_my_own_status(user_id)
+        await self.send_me_my_own_status(user_id, status)
+        return True
 
     async def info_process(self, data):
         """ answers backend requests on channel 'info_social' """
@@ -125,20 +192,21 @@ class Command(BaseCommand):
             print(e)
             return
         if user_id:
-            status = self.user_status.get(user_id, "offline")
+            status = await self.get_status(user_id)
         key = f"user_{user_id}_status"
         await self.redis_client.set(key, status, ex = 2)
 
         
     async def auth_process(self, data):
-        """ answers backend requests on channel 'auth_social' """
+        """ answers backend requests on channel 'auth_social'.\n
+        Auth and the gateway read the presence directly now, kept for older callers """
         try:
             user_id = int(data.get('user_id', 'x'))
         except Exception as e:
             print(e)
             return
         if user_id:
-            status = self.user_status.get(user_id, "offline")
+            status = await self.get_status(user_id)
         key = f"is_{user_id}_logged"
         await self.redis_client.set(key, status, ex = 2)
 
@@ -184,21 +252,21 @@ class Command(BaseCommand):
 
     async def send_me_my_friends_status(self, user_id, friends):
         """ publish status of all friends and adress them to 'user_id' """
-        for friend in friends:
-            data = self.build_social_data(user_id, friend)
-            await self.redis_client.publish(self.REDIS_GROUPS['gateway'], json.dumps(data))
+        for friend, status in zip(friends, await self.get_statuses(friends)):
+            data = self.build_social_data(user_id, friend, status)
+            await publish_front(self.redis_client, self.REDIS_GROUPS['gateway'], data)
 
-    async def send_me_my_own_status(self, user_id):
+    async def send_me_my_own_status(self, user_id, status):
         """ publish my status and adress them to me """
-        data = self.build_social_data(user_id, user_id)
-        await self.redis_client.publish(self.REDIS_GROUPS['gateway'], json.dumps(data))
+        data = self.build_social_data(user_id, user_id, status)
+        await publish_front(self.redis_client, self.REDIS_GROUPS['gateway'], data)
 
-    async def send_my_status(self, user_id, friend):
+    async def send_my_status(self, user_id, friend, status):
         """ publish status of 'user_id' and adress it to 'friend', and also to 'user_id' """
-        data = self.build_social_data(friend, user_id)
-        await self.redis_client.publish(self.REDIS_GROUPS['gateway'], json.dumps(data))
+        data = self.build_social_data(friend, user_id, status)
+        await publish_front(self.redis_client, self.REDIS_GROUPS['gateway'], data)
 
-    def build_social_data(self, user_id, friend):
+    def build_social_data(self, user_id, friend, status):
         """user_id will receive friend info"""
         data = {
             "header": {
@@ -208,7 +276,7 @@ class Command(BaseCommand):
             },
             "body":{
                 "user_id": friend,
-                "status": self.user_status.get(friend, "offline")
+                "status": status
             }
         }
         return data
@@ -228,6 +296,7 @@ class Command(BaseCommand):
     def signal_handler(self, sig, frame):
         try:
             self.listen_task.cancel()
+            self.stream_task.cancel()
         except Exception as e:
             print(e)
         self.running = False
@@ -235,7 +304,6 @@ class Command(BaseCommand):
     async def cleanup_redis(self):
         print("Cleaning up Redis connections...")
         if self.pubsub:
-            await self.pubsub.unsubscribe(self.REDIS_GROUPS['gateway'])
+            await self.pubsub.unsubscribe(self.REDIS_GROUPS['info'], self.REDIS_GROUPS['auth'])
             await self.pubsub.close()
-        if self.redis_client:
-            await self.redis_client.close()
\ No newline at end of file
+        await redis_pool.close()
\ No newline at end of file